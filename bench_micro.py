@@ -0,0 +1,373 @@
+"""
+Micro-benchmarks of the local hot paths (OCI is not called)
+
+    - split_in_chunks, synthetic transcripts from 10 KB to 50 MB
+    - index (FAISS) build and search at different chunk counts
+    - add_message/get_conversation with many conversations
+    - serialization of the answer with citations
+
+embeddings are deterministic fake vectors (utils_bench.FakeEmbeddings).
+Results are saved as JSON; with --baseline they're compared with a stored
+run. The best time (min) of every case is compared: the noise of a
+machine only makes a run slower. A case is a regression if it's slower
+than the threshold and the difference is more than the noise of the
+baseline (median - min), exit code 1.
+Compare runs done on the same kind of machine.
+
+usage:
+    python bench_micro.py [--quick] [--output bench_results.json]
+                          [--baseline bench_baseline.json] [--threshold 0.25]
+    python bench_micro.py --save-baseline [--baseline bench_baseline.json]
+"""
+
+import argparse
+import gc
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import orjson
+
+from utils import get_app_config, get_console_logger
+from utils_bench import synthetic_transcript
+
+app_config = get_app_config()
+
+# we measure the CPU work, not the cache
+app_config["shared_cache"]["enabled"] = False
+
+# no log lines at every call
+get_console_logger().setLevel(logging.WARNING)
+
+KB = 1024
+MB = 1024 * KB
+
+SPLIT_SIZES = [10 * KB, 100 * KB, MB, 10 * MB, 50 * MB]
+INDEX_SIZES = [1000, 10000, 50000]
+N_CONVERSATIONS = 10000
+
+# quick mode, for a fast check on a laptop
+QUICK_SPLIT_SIZES = [10 * KB, 100 * KB, MB]
+QUICK_INDEX_SIZES = [1000, 10000]
+QUICK_N_CONVERSATIONS = 1000
+
+# n. of queries for a search measure
+N_QUERIES = 100
+
+# measures of a case (less for the big inputs)
+REPEAT = 20
+
+
+def measure(func, repeat, number=1):
+    """
+    time func: repeat measures, each of number calls
+    return the timings of a call in msec.
+    (number > 1 for fast calls, to reduce the noise)
+    the garbage collector is disabled while measuring, like timeit:
+    a collection of the objects of another case is not counted here
+    """
+    timings = []
+
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            time_start = time.perf_counter()
+            for _ in range(number):
+                func()
+            timings.append((time.perf_counter() - time_start) * 1000 / number)
+    finally:
+        gc.enable()
+
+    return {
+        "median_ms": round(statistics.median(timings), 4),
+        "min_ms": round(min(timings), 4),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def _repeat_for(size):
+    """
+    less runs for the big inputs
+    """
+    if size >= 50 * MB:
+        return 3
+    if size >= 10 * MB:
+        return 5
+
+    return REPEAT
+
+
+def bench_split(sizes):
+    """
+    split_in_chunks on transcripts of different sizes
+    """
+    from utils_chuncking import split_in_chunks
+    from utils_executor import warm_process_pool
+
+    # big docs are split in the process pool: start it before measuring
+    warm_process_pool()
+
+    results = {}
+    for size in sizes:
+        text = synthetic_transcript(size, seed=size)
+
+        result = measure(
+            lambda: split_in_chunks([text]),
+            _repeat_for(size),
+            number=max(MB // size, 1),
+        )
+        result["n_chunks"] = len(split_in_chunks([text]))
+
+        results[f"split/{size // KB}KB"] = result
+
+    return results
+
+
+def bench_index(sizes):
+    """
+    build of the index and search (with the rerank stage)
+    """
+    from utils_bench import FakeEmbeddings
+    from utils_index import ChunkIndex, add_to_index
+    from utils_rerank import retrieve
+
+    embed_model = FakeEmbeddings()
+    dim = embed_model.dim
+    results = {}
+
+    for n_chunks in sizes:
+        vectors = np.asarray(
+            embed_model.embed_documents([f"chunk {i}" for i in range(n_chunks)]),
+            dtype=np.float32,
+        )
+        items = list(range(n_chunks))
+        queries = np.asarray(
+            embed_model.embed_documents(
+                [f"query {i} of {n_chunks}" for i in range(N_QUERIES)]
+            ),
+            dtype=np.float32,
+        )
+
+        def build():
+            index = ChunkIndex.from_config(dim)
+            add_to_index(index, items, vectors)
+
+            return index
+
+        repeat = 5 if n_chunks >= 50000 else REPEAT
+        results[f"index_build/{n_chunks}"] = measure(build, repeat)
+
+        index = build()
+
+        def search():
+            for query in queries:
+                retrieve(index, query)
+
+        result = measure(search, repeat)
+        result["n_queries"] = N_QUERIES
+        results[f"index_search/{n_chunks}"] = result
+
+    return results
+
+
+def bench_conversations(n_conversations):
+    """
+    add_message and get_conversation with many conversations
+    """
+    import main
+    from utils_shared_state import get_shared_state
+
+    rng = np.random.default_rng(42)
+    conv_ids = [f"conv-{i}" for i in range(n_conversations)]
+    get_shared_state().clear()
+
+    # every conversation is full
+    for conv_id in conv_ids:
+        for _ in range(app_config["llm"]["max_num_msgs"] // 2):
+            main.add_message(conv_id, "USER", "Who is Lisa Miller?")
+            main.add_message(conv_id, "CHATBOT", "Lisa Miller is the manager.")
+
+    picked = [conv_ids[i] for i in rng.integers(n_conversations, size=1000)]
+
+    def add_messages():
+        for conv_id in picked:
+            main.add_message(conv_id, "USER", "Where does she live?")
+            main.add_message(conv_id, "CHATBOT", "In Rome.")
+
+    def get_conversations():
+        for conv_id in picked:
+            main.get_conversation(conv_id)
+
+    results = {
+        f"add_message/{n_conversations}convs": measure(add_messages, REPEAT),
+        f"get_conversation/{n_conversations}convs": measure(
+            get_conversations, REPEAT, number=5
+        ),
+    }
+    get_shared_state().clear()
+
+    return results
+
+
+def bench_serialization():
+    """
+    citations mapped to the chunks + orjson, 100 responses
+    """
+    from langchain_core.documents import Document
+
+    from utils_serialization import build_citations_output
+
+    text = synthetic_transcript(20 * KB, seed=7)
+    chunks = [
+        Document(
+            page_content=text[start : start + 1500],
+            metadata={
+                "chunk_id": f"0:{start}",
+                "doc_index": 0,
+                "start_index": start,
+                "end_index": start + 1500,
+            },
+        )
+        for start in range(0, 15000, 1500)
+    ]
+    citations = [
+        {
+            "start": i * 10,
+            "end": i * 10 + 30,
+            "text": chunks[i % len(chunks)].page_content[100:140],
+            "document_ids": [chunks[i % len(chunks)].metadata["chunk_id"]],
+        }
+        for i in range(30)
+    ]
+    response = SimpleNamespace(
+        content=text[:2000], additional_kwargs={"citations": citations}
+    )
+
+    def serialize():
+        for _ in range(100):
+            orjson.dumps(build_citations_output(response, chunks))
+
+    return {"serialization/citations": measure(serialize, REPEAT)}
+
+
+def compare(results, baseline, threshold):
+    """
+    add the baseline to the results, return the names of the regressions
+    """
+    regressions = []
+
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+
+        ratio = result["min_ms"] / max(base["min_ms"], 1e-6)
+        result["baseline_min_ms"] = base["min_ms"]
+        result["ratio"] = round(ratio, 3)
+
+        # the noise of the case, measured in the baseline run
+        noise = base["median_ms"] - base["min_ms"]
+
+        if ratio > 1 + threshold and result["min_ms"] - base["min_ms"] > noise:
+            regressions.append(name)
+
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(quick):
+    """
+    run all the benchmarks, return the results
+    """
+    results = {}
+    results.update(bench_split(QUICK_SPLIT_SIZES if quick else SPLIT_SIZES))
+    results.update(bench_index(QUICK_INDEX_SIZES if quick else INDEX_SIZES))
+    results.update(
+        bench_conversations(QUICK_N_CONVERSATIONS if quick else N_CONVERSATIONS)
+    )
+    results.update(bench_serialization())
+
+    return results
+
+
+def main():
+    """
+    run the benchmarks, save and compare the results
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = run(args.quick)
+
+    output = {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "quick": args.quick,
+            "index_quantization": app_config["index"]["quantization"],
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if args.save_baseline:
+        file_name = args.baseline or "bench_baseline.json"
+    else:
+        file_name = args.output
+
+        if args.baseline is not None:
+            with open(args.baseline, "rb") as file:
+                baseline = orjson.loads(file.read())
+
+            regressions = compare(results, baseline, args.threshold)
+            output["regressions"] = regressions
+
+    with open(file_name, "wb") as file:
+        file.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+
+    print(f"{'case':32s} {'min ms':>12s} {'baseline':>12s} {'ratio':>7s}")
+    for name, result in results.items():
+        baseline_ms = result.get("baseline_min_ms", "")
+        ratio = result.get("ratio", "")
+        flag = "  <-- regression" if name in regressions else ""
+
+        print(
+            f"{name:32s} {result['min_ms']:12.3f} {baseline_ms!s:>12s} "
+            f"{ratio!s:>7s}{flag}"
+        )
+
+    print("")
+    print(f"Results saved in {file_name}")
+
+    if regressions:
+        print(f"{len(regressions)} regressions (threshold {args.threshold:.0%})")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark: throughput of the local (CPU bound) work of a request
+with 1, 2, 4, ... worker processes
+
+every simulated request does what a worker does locally for /v2/answer:
+split the transcript, (fake) embeddings, build the index, search,
+rerank and serialize the response. OCI is not called.
+
+usage:
+    python bench_workers.py [--requests 64] [--size-kb 200] [--max-workers N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import orjson
+
+from utils import get_app_config
+from utils_bench import FakeEmbeddings, synthetic_transcript
+
+app_config = get_app_config()
+
+# we measure the CPU work, not the cache
+app_config["shared_cache"]["enabled"] = False
+
+
+def simulated_request(seed, size_kb):
+    """
+    the local work of a request, return the n. of chunks
+    """
+    from utils_chuncking import split_document
+    from utils_index import build_chunk_index
+    from utils_rerank import retrieve
+
+    text = synthetic_transcript(size_kb * 1024, seed=seed)
+    embed_model = FakeEmbeddings()
+
+    docs = split_document(text)
+    index = build_chunk_index(docs, embed_model)
+    results = retrieve(index, embed_model.embed_query("Who is Lisa Miller?"))
+
+    orjson.dumps(
+        [{"snippet": doc.page_content, "score": score} for doc, score in results]
+    )
+
+    return len(docs)
+
+
+def run(n_workers, n_requests, size_kb):
+    """
+    return requests/sec with n_workers processes
+    """
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        # warm-up of the workers (imports)
+        list(pool.map(simulated_request, range(n_workers), [1] * n_workers))
+
+        time_start = time.perf_counter()
+        list(pool.map(simulated_request, range(n_requests), [size_kb] * n_requests))
+        elapsed = time.perf_counter() - time_start
+
+    return n_requests / elapsed
+
+
+def main():
+    """
+    run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--size-kb", type=int, default=200)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    n_workers_list = []
+    n_workers = 1
+    while n_workers <= args.max_workers:
+        n_workers_list.append(n_workers)
+        n_workers *= 2
+
+    print(f"CPU cores: {multiprocessing.cpu_count()}")
+    print(f"Requests: {args.requests}, transcript size: {args.size_kb} KB")
+    print("")
+    print("workers  req/sec  speedup")
+
+    baseline = None
+    for n_workers in n_workers_list:
+        throughput = run(n_workers, args.requests, args.size_kb)
+
+        if baseline is None:
+            baseline = throughput
+
+        print(f"{n_workers:7d}  {throughput:7.2f}  {throughput / baseline:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Gunicorn settings for the multi-process mode (see start_api_workers.sh)
+
+every worker is a uvicorn worker running main:app,
+settings are in the [workers] section of config.toml
+
+the workers share the conversations and the other state in
+[shared_state], emptied when gunicorn starts
+"""
+
+import multiprocessing
+import os
+
+from utils import get_app_config
+from utils_shared_state import SHARED_STATE_ENV, FileStateStore
+
+app_config = get_app_config()
+
+_num_workers = app_config["workers"]["num_workers"]
+
+bind = f"{app_config['fastapi']['api_host']}:{app_config['fastapi']['api_port']}"
+workers = _num_workers if _num_workers > 0 else multiprocessing.cpu_count()
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = app_config["workers"]["timeout"]
+max_requests = app_config["workers"]["max_requests"]
+max_requests_jitter = app_config["workers"]["max_requests_jitter"]
+
+# the app is not preloaded: every worker creates its own OCI clients
+# (and threads) after the fork, and runs its own warm-up
+preload_app = False
+
+# inherited by the workers: the state is kept in files, shared
+os.environ[SHARED_STATE_ENV] = "1"
+
+
+def on_starting(server):
+    """
+    remove the state of a previous run
+    """
+    FileStateStore(app_config["shared_state"]["directory"]).clear()
@@ -14,31 +14,77 @@ It provides several operations:
     12/10/2024
         migrated to last version of langchain, langchain-community
         using ChatOCIGenai
+    19/10/2026
+        added resilience layer (retries, hedging, circuit breaker)
+        for calls to chat and embeddings
+        added admission control and rate limiting (middleware)
+        answer_with_citations returns structured JSON (orjson),
+        gzip for responses, compressed request bodies accepted
+        fast startup: lazy import of heavy modules, warm-up in background,
+        readiness endpoint
+        retrieval with our own index (utils_index), optionally with
+        int8/PQ quantized vectors and full precision rescoring
+        the index of a conversation is cached and updated incrementally
+        (only the new text of a growing transcript is split and embedded)
+        rerank stage after retrieval: MMR and adaptive k (score gap)
+        multi-process mode (gunicorn, start_api_workers.sh), embeddings and
+        chunks cached in memory mapped files shared by the workers
+        splitting and index construction for big inputs done in a pool
+        of processes (utils_executor), vectors in shared memory
+        citations in answer_with_citations have the doc index and the
+        offsets in the original documents (chunk metadata)
+        opt-in profiling: request traces (spans) and on-demand
+        cProfile/sampling captures, from the /admin/ endpoints
+        follow-up queries rewritten using the history, retrieval with
+        the raw and rewritten query (results fused)
+        model switching with change_config, routing between command-r
+        and command-r-plus (prompt size, latency), stats per model
+        request bodies read as a stream with size limits (413),
+        summarize doesn't copy the whole input
+        prepare: documents split, embedded and indexed in background
+        (queue with priorities), answers join the work in progress
+        multi-process mode: conversations, settings changed, prepare jobs,
+        rate limits and indexes of the conversations shared by the workers
 """
 
+import os
 import traceback
-from typing import List, Dict, Optional
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
 import time
+import uuid
 
-import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, ORJSONResponse
 from pydantic import BaseModel
 
-from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
-from langchain_community.chat_models.oci_generative_ai import ChatOCIGenAI
-from langchain_community.vectorstores import FAISS
-
-from oci_cohere_embeddings_utils import OCIGenAIEmbeddingsWithBatch
-
 from utils import (
+    get_app_config,
     get_console_logger,
     print_configuration,
-    read_configuration,
     read_preamble,
 )
-from utils_chuncking import split_in_chunks
+from utils_admission import AdmissionMiddleware
+from utils_chuncking import join_documents, split_in_chunks
+from utils_models import get_embedding_model
+from utils_profiling import check_admin_token, profiler, span
+from utils_routing import invoke_chat, router, set_model
+from utils_serialization import (
+    build_citations_output,
+    CompressedJSONRequest,
+    CompressedJSONRoute,
+)
+from utils_shared_state import (
+    get_shared_state,
+    set_config_overrides,
+    sync_config_overrides,
+)
+from utils_warmup import start_warmup, warmup_state
+
+# LangChain, FAISS and OCI are imported only when needed
+# (or by the warm-up), to keep the startup fast
 
 
 # this represent the input to api
@@ -68,6 +114,27 @@ class MessageConfig(BaseModel):
     id_model: Optional[str] = None
 
 
+class MessageProfile(BaseModel):
+    """
+    The message to start a profile of the running worker
+    """
+
+    mode: Literal["cprofile", "sampling"] = "sampling"
+    # sampling: duration of the capture
+    seconds: float = 5.0
+    # cprofile: n. of the next requests profiled
+    n_requests: int = 1
+
+
+class MessagePrepare(BaseModel):
+    """
+    The message to prepare (split, embed, index) documents in background
+    """
+
+    documents: List[str]
+    priority: Literal["high", "normal", "low"] = "normal"
+
+
 class MessageSummarize(BaseModel):
     """ "
     The message to handle summarization
@@ -84,19 +151,53 @@ class MessageSummarize(BaseModel):
 #
 # media type for the output
 MEDIA_TYPE_NOSTREAM = "text/plain"
-MEDIA_TYPE_NOSTREAM_JSON = "application/json"
 
 
 #
 # Main
 #
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    startup: the warm-up runs in background,
+    see the /ready/ endpoint
+    """
+    start_warmup()
 
-# global Object to handle conversation history
-conversations: Dict[str, List[BaseMessage]] = {}
+    yield
+
+
+def sync_config():
+    """
+    apply the config changes made by the other workers (change_config)
+    not async: it reads a file (stat, locked read), FastAPI runs it
+    in the thread pool, not on the event loop
+    """
+    sync_config_overrides()
+
+
+# JSON responses are encoded with orjson
+app = FastAPI(
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+    dependencies=[Depends(sync_config)],
+)
+# request bodies can be compressed (gzip, deflate, br) and are parsed with orjson
+app.router.route_class = CompressedJSONRoute
 
 logger = get_console_logger()
 
+# read only once, shared with the other modules
+app_config = get_app_config()
+
+# added before CORS, so that also 429 responses get CORS headers
+if app_config["admission"]["enabled"]:
+    app.add_middleware(
+        AdmissionMiddleware,
+        config=app_config["admission"],
+        max_body_size=app_config["http"]["max_body_size_mb"] * 1024 * 1024,
+    )
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -105,7 +206,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app_config = read_configuration("config.toml")
+# compress big responses, if the client accepts gzip
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=app_config["http"]["gzip_minimum_size"],
+    compresslevel=app_config["http"]["gzip_level"],
+)
+# limits on the request bodies, checked while they're read
+CompressedJSONRequest.max_body_size = app_config["http"]["max_body_size_mb"] * 1024 * 1024
+CompressedJSONRequest.max_decompressed_size = (
+    app_config["http"]["max_decompressed_size_mb"] * 1024 * 1024
+)
+CompressedJSONRequest.payload_limits = {
+    "max_documents": app_config["http"]["max_documents"],
+    "max_document_chars": app_config["http"]["max_document_chars"],
+    "max_query_chars": app_config["http"]["max_query_chars"],
+}
 
 
 #
@@ -118,79 +234,51 @@ def add_message(conv_id, role, txt):
     If the conversation doesn't exist create it
     role: can be USER or CHAT
     txt: str, the text of the message
+
+    conversations are shared by the workers (see utils_shared_state),
+    a msg is saved as [role, txt]
     """
     verbose = app_config["general"]["verbose"]
+    max_num_msgs = app_config["llm"]["max_num_msgs"]
 
-    if conv_id not in conversations:
-        # create it
-        if verbose:
-            logger.info("Creating conversation id: %s", conv_id)
+    def add(conversation):
+        if conversation is None:
+            # create it
+            if verbose:
+                logger.info("Creating conversation id: %s", conv_id)
 
-        conversations[conv_id] = []
+            conversation = []
 
-    # add the request to the conversation
-    if role == "USER":
-        msg = HumanMessage(content=txt)
-    else:
-        # ai message
-        msg = AIMessage(content=txt)
+        # add the msg
+        conversation.append([role, txt])
+
+        # to keep only MAX_NUM_MSGS in the conversation
+        if len(conversation) > max_num_msgs:
+            if verbose:
+                logger.info("Removing old msg from conversation id: %s", conv_id)
+            # remove first (older) el from conversation
+            del conversation[: len(conversation) - max_num_msgs]
+
+        return conversation
 
-    # identify the conversation
-    conversation = conversations[conv_id]
-    # add the msg
-    conversation.append(msg)
+    get_shared_state().update(f"conv:{conv_id}", add)
 
     if verbose:
         logger.info("Added msg to conversation id: %s", conv_id)
 
-    # to keep only MAX_NUM_MSGS in the conversation
-    if len(conversation) > app_config["llm"]["max_num_msgs"]:
-        if verbose:
-            logger.info("Removing old msg from conversation id: %s", conv_id)
-        # remove first (older) el from conversation
-        conversation.pop(0)
-
 
 def get_conversation(v_conv_id):
     """
     return a conversation as List[CohereMessage]
     """
-    if v_conv_id not in conversations:
-        conversation = []
-    else:
-        conversation = conversations[v_conv_id]
+    from langchain_core.messages import HumanMessage, AIMessage
 
-    return conversation
+    conversation = get_shared_state().get(f"conv:{v_conv_id}") or []
 
-
-def get_chat_model():
-    """
-    Build an instance of Chat Model
-    """
-    chat_model = ChatOCIGenAI(
-        auth_type=app_config["oci"]["auth"],
-        model_id=app_config["oci"]["model_id"],
-        service_endpoint=app_config["oci"]["endpoint"],
-        compartment_id=app_config["oci"]["compartment_ocid"],
-        model_kwargs={
-            "temperature": app_config["llm"]["temperature"],
-            "max_tokens": app_config["llm"]["max_tokens"],
-        },
-    )
-    return chat_model
-
-
-def get_embedding_model():
-    """
-    Build an instance of Embedding Model
-    """
-    embed_model = OCIGenAIEmbeddingsWithBatch(
-        auth_type=app_config["oci"]["auth"],
-        model_id=app_config["embeddings"]["model_id"],
-        service_endpoint=app_config["embeddings"]["embed_endpoint"],
-        compartment_id=app_config["oci"]["compartment_ocid"],
-    )
-    return embed_model
+    return [
+        HumanMessage(content=txt) if role == "USER" else AIMessage(content=txt)
+        for role, txt in conversation
+    ]
 
 
 #
@@ -201,80 +289,122 @@ def handle_request_v2(request: Message, conv_id: str):
     handle a request to LLM inside a conversation
     handle also chunking and semantic search into chunks
     conv_id : identify the conversation (chat_history)
+    return (response, chunks sent to the model)
     """
-    # we could have input in more than 1 txt
-    # split in chunks
-    docs = split_in_chunks(request.documents)
+    # numpy/faiss imported here, to keep the startup fast
+    from utils_index import build_chunk_index
+    from utils_index_cache import index_cache
+    from utils_prepare import prepare_queue
+    from utils_query_rewrite import SpeculativeQuery
+    from utils_rerank import retrieve
 
-    # create a Vector Store with Faiss
     embed_model = get_embedding_model()
 
-    db = FAISS.from_documents(docs, embed_model)
+    # get the chat history from conv_id
+    # if it is the first request it creates a new conversation
+    # and you get []
+    chat_history = get_conversation(conv_id)
+
+    # the query (raw and rewritten using the history) is embedded
+    # in background, while the index is updated. See [query_rewrite]
+    query = SpeculativeQuery(embed_model, request.query, chat_history)
 
-    # do semantic search to retrieve a subset of chunks
-    # results is a list of (doc, score), score=distance
-    # default distance is L2, first returned are better
-    results = db.similarity_search_with_score(
-        request.query, k=app_config["retriever"]["k"]
-    )
+    if app_config["index_cache"]["enabled"]:
+        # the index of the conversation is kept and updated:
+        # only the new text is split and embedded.
+        # If a prepare job is running we wait for it,
+        # if it's still in the queue we do the work here
+        prepare_queue.join(conv_id)
 
-    # take only the txts
-    docs_txt = [doc.page_content for (doc, score) in results]
+        with index_cache.conversation(conv_id) as conv:
+            index = conv.update(request.documents, embed_model)
+
+            with span("embed"):
+                query_vectors = query.query_vectors()
+
+            with span("search"):
+                results = retrieve(index, query_vectors) if index is not None else []
+    else:
+        # a running prepare job puts the embeddings in the shared cache:
+        # we wait for it, so that they are not computed again
+        prepare_queue.join(conv_id)
+
+        # we could have input in more than 1 txt
+        # split in chunks
+        with span("split"):
+            docs = split_in_chunks(request.documents)
+
+        # create the index (with Faiss), vectors can be quantized
+        # see [index] in config.toml
+        index = build_chunk_index(docs, embed_model)
+
+        with span("embed"):
+            query_vectors = query.query_vectors()
+
+        # do semantic search to retrieve a subset of chunks
+        # with the raw and rewritten query (results are fused)
+        # + rerank (MMR, adaptive k), see [rerank] in config.toml
+        # results is a list of (doc, score), score=distance
+        # distance is L2
+        with span("search"):
+            results = retrieve(index, query_vectors)
+
+    # the chunks selected, they have in metadata doc_index,
+    # offsets in the original doc and chunk_id
+    chunks = [doc for (doc, score) in results]
 
     # prepare documents in the right format for Cohere
     # for now documents are provided from client as a List[str]
 
-    # Cohere wants a map
-    documents = [{"snippet": doc} for doc in docs_txt]
-
-    # get the chat history from conv_id
-    # if it is the first request it creates a new conversation
-    # and you get []
-    chat_history = get_conversation(conv_id)
+    # Cohere wants a map. With the id, citations refer to our chunk_id
+    documents = [
+        {"id": doc.metadata["chunk_id"], "snippet": doc.page_content}
+        for doc in chunks
+    ]
 
-    # create the client for OCI Cohere command-r/r-plus
     try:
-        chat = get_chat_model()
-
-        # here we invoke the model
-        response = chat.invoke(
-            request.query, chat_history=chat_history, documents=documents
-        )
+        # here we invoke the model (with retries, hedging, circuit breaker)
+        # command-r or command-r-plus, chosen by the router ([routing])
+        with span("llm"):
+            response = invoke_chat(
+                "answer", request.query, documents, chat_history
+            )
     except Exception as e:
         logger.error("Error in handle_request_v2:")
         logger.error(traceback.format_exc())
         logger.error(e)
+        # the caller handles the error
+        raise
 
-    return response
+    return response, chunks
 
 
 def handle_summarize_v2(request: MessageSummarize):
     """
     handle a request to LLM to summarize a list of txt
     """
-    full_content = "\n".join(request.documents)
     # added 09/07
     lang = request.language
 
     # need to be sure that the max lenght is not > context_window
     max_input_size = app_config["summarize"]["max_input_size"]
 
-    if len(full_content) > max_input_size:
+    # only the part used is copied (no join of the whole input)
+    full_content, truncated = join_documents(request.documents, max_input_size)
+
+    if truncated:
         logger.info("Truncating input for summarize...")
-        full_content = full_content[:max_input_size]
 
     # Cohere wants a map
     documents = [{"snippet": full_content}]
 
-    # create the client for OCI Cohere command-r/r-plus
-    chat = get_chat_model()
-
     # handle language (09/07)
     request = read_preamble(f"request_sum_{lang}")
 
-    # here we invoke the model
+    # here we invoke the model (command-r, if the input fits)
     # no chat_history
-    response = chat.invoke(request, chat_history=[], documents=documents)
+    with span("llm"):
+        response = invoke_chat("summarize", request, documents, [])
 
     return response
 
@@ -296,6 +426,15 @@ tags_metadata = [
         "name": "Configuration",
         "description": "Operation to handle config changes.",
     },
+    {
+        "name": "Health",
+        "description": "Readiness of the API.",
+    },
+    {
+        "name": "Admin",
+        "description": "Request traces and profiles of the worker serving "
+        "the request (X-Admin-Token required).",
+    },
 ]
 
 
@@ -307,13 +446,28 @@ def delete(conv_id: str):
     """
     logger.info("Called delete, conv_id: %s...", conv_id)
 
-    if conv_id not in conversations:
+    if app_config["index_cache"]["enabled"]:
+        from utils_index_cache import index_cache
+
+        index_cache.drop(conv_id)
+
+    if not get_shared_state().delete(f"conv:{conv_id}"):
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    del conversations[conv_id]
     return {"conv_id": conv_id, "messages": []}
 
 
+# for the autoscaler/load balancer
+@app.get("/ready/", tags=["Health"])
+def ready():
+    """
+    return 200 when the warm-up is done, 503 otherwise
+    """
+    state = warmup_state.to_dict()
+
+    return ORJSONResponse(content=state, status_code=200 if state["ready"] else 503)
+
+
 # to handle change in configs
 @app.get("/get_config/", tags=["Configuration"])
 def get_config():
@@ -323,29 +477,119 @@ def get_config():
     return app_config
 
 
+@app.get("/get_stats/", tags=["Configuration"])
+def get_stats():
+    """
+    return statistics on the retrieval, on the query rewrite
+    and per model (latency, tokens)
+    """
+    from utils_query_rewrite import rewrite_stats
+    from utils_rerank import retrieval_stats
+
+    return {
+        "retrieval": retrieval_stats.to_dict(),
+        "query_rewrite": rewrite_stats.to_dict(),
+        "models": router.to_dict(),
+    }
+
+
+#
+# profiling (see [profiling] in config.toml)
+#
+def check_admin(token):
+    """
+    raise 403 if token is not the admin token
+    """
+    if not check_admin_token(token):
+        raise HTTPException(status_code=403, detail="Not allowed.")
+
+
+@app.get("/admin/traces/", tags=["Admin"])
+def get_traces(
+    limit: int = Query(50, ge=1, le=app_config["profiling"]["max_traces"]),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    return the last request traces (spans), most recent first
+    """
+    check_admin(x_admin_token)
+
+    return {
+        "enabled": app_config["profiling"]["enabled"],
+        # traces and profiles are kept by each worker
+        "worker_pid": os.getpid(),
+        "traces": profiler.get_traces(limit),
+    }
+
+
+@app.post("/admin/profile/", tags=["Admin"])
+def start_profile(
+    request: MessageProfile, x_admin_token: Optional[str] = Header(None)
+):
+    """
+    sampling: sample the stacks of the worker for some seconds, return the result
+    cprofile: profile the next requests, results in /admin/profiles/
+    """
+    check_admin(x_admin_token)
+
+    config = app_config["profiling"]
+
+    if request.mode == "cprofile":
+        profiler.arm_cprofile(request.n_requests)
+
+        return {"mode": "cprofile", "armed_requests": request.n_requests}
+
+    seconds = min(max(request.seconds, 0.0), config["max_sampling_seconds"])
+
+    try:
+        return profiler.sample(seconds, config["sampling_interval"])
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+
+
+@app.get("/admin/profiles/", tags=["Admin"])
+def get_profiles(x_admin_token: Optional[str] = Header(None)):
+    """
+    return the last profiles captured
+    """
+    check_admin(x_admin_token)
+
+    return {"worker_pid": os.getpid(), "profiles": list(profiler.captures)}
+
+
 @app.post("/change_config/", tags=["Configuration"])
 def change_config(request: MessageConfig):
     """
     handle the change of configuration
 
     saupported: verbose, preamble_id and model_id
+    model_id: one of [routing] models, or "auto" for routing
+    changes are applied by all the workers
     """
     if request.token == "4321":
         logger.info("Config change:")
 
         if request.verbose is not None:
             logger.info("New value for verbose: %s", request.verbose)
-            app_config["general"]["verbose"] = request.verbose
+            set_config_overrides({"general.verbose": request.verbose})
 
         if request.preamble_id is not None:
             logger.info("New preamble id: %s", request.preamble_id)
 
-            app_config["oci"]["preamble_id"] = request.preamble_id
+            set_config_overrides({"oci.preamble_id": request.preamble_id})
 
             print_configuration(app_config)
 
         if request.id_model is not None:
             logger.info("New model id: %s", request.id_model)
+
+            # a model id pins the model, "auto" enables the routing
+            try:
+                set_model(request.id_model)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e)) from e
+
+            print_configuration(app_config)
     else:
         raise HTTPException(status_code=400, detail="Change not allowed.")
 
@@ -364,17 +608,19 @@ def answer_v2(request: Message, conv_id: str):
     logger.info("Called answer, conv_id: %s...", conv_id)
 
     try:
-        response = handle_request_v2(request, conv_id)
+        with profiler.request("/v2/answer/", conv_id=conv_id):
+            response, _ = handle_request_v2(request, conv_id)
 
-        # extract only the text from response
-        output = response.content
+            # extract only the text from response
+            output = response.content
 
-        if app_config["general"]["verbose"]:
-            logger.info(response.content)
+            if app_config["general"]["verbose"]:
+                logger.info(response.content)
 
-        # add request/response to conversation history
-        add_message(conv_id, "USER", request.query)
-        add_message(conv_id, "CHATBOT", output)
+            # add request/response to conversation history
+            with span("history"):
+                add_message(conv_id, "USER", request.query)
+                add_message(conv_id, "CHATBOT", output)
 
     except Exception as e:
         logger.error("Error in answer V2 %s", e)
@@ -392,34 +638,95 @@ def answer_with_citation_v2(request: Message, conv_id: str):
     """
     Get a request + a set of documents and answer
     using command_r/r_plus
+    the sources of a citation have the offsets of the chunk cited
+    (match: "chunk"), or of the quote when the answer quotes the
+    document word for word (match: "verbatim")
     """
     time_start = time.time()
 
     logger.info("Called answer_with_citations, conv_id: %s...", conv_id)
 
     try:
-        response = handle_request_v2(request, conv_id)
+        with profiler.request("/v2/answer_with_citations/", conv_id=conv_id):
+            response, chunks = handle_request_v2(request, conv_id)
 
-        # extract the text and citations from response
-        output = response.data
+            # extract the text and citations from response
+            # citations are mapped to the offsets in the original documents
+            output = build_citations_output(response, chunks)
 
-        if app_config["general"]["verbose"]:
-            logger.info(response.data)
+            if app_config["general"]["verbose"]:
+                logger.info(output)
 
-        # add request/response to conversation history
-        add_message(conv_id, "USER", request.query)
-        # only the txt is saved in the history
-        add_message(conv_id, "CHATBOT", output.chat_response.text)
+            # add request/response to conversation history
+            with span("history"):
+                add_message(conv_id, "USER", request.query)
+                # only the txt is saved in the history
+                add_message(conv_id, "CHATBOT", output["text"])
 
     except Exception as e:
         logger.error("Error in answer_with_citations V2 %s", e)
-        output = f"Error in answer_with_citations V2: {e}"
+        output = {"error": f"Error in answer_with_citations V2: {e}"}
 
     time_elapsed = time.time() - time_start
     logger.info("Elapsed time: %s sec.", round(time_elapsed, 1))
     logger.info("")
 
-    return Response(content=str(output), media_type=MEDIA_TYPE_NOSTREAM_JSON)
+    return ORJSONResponse(content=output)
+
+
+@app.post("/v2/prepare/", tags=["V2"], status_code=202)
+def prepare_v2(request: MessagePrepare, conv_id: Optional[str] = None):
+    """
+    Get a set of documents and prepare them in background
+    (split, embeddings, index), returns immediately.
+    If conv_id is not given a new one is returned,
+    to be used in the following requests
+    """
+    from utils_prepare import prepare_queue, QueueFullError
+
+    config = app_config
+
+    if not config["prepare"]["enabled"]:
+        raise HTTPException(status_code=404, detail="Prepare not enabled.")
+
+    if not (config["index_cache"]["enabled"] or config["shared_cache"]["enabled"]):
+        # the result would be lost
+        raise HTTPException(
+            status_code=400, detail="Prepare needs index_cache or shared_cache."
+        )
+
+    if conv_id is None:
+        conv_id = uuid.uuid4().hex
+
+    logger.info("Called prepare, conv_id: %s...", conv_id)
+
+    try:
+        job = prepare_queue.submit(conv_id, request.documents, request.priority)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429, detail=str(e), headers={"Retry-After": "1"}
+        ) from e
+
+    return job.to_dict()
+
+
+@app.get("/v2/prepare/status/", tags=["V2"])
+def prepare_status_v2(job_id: Optional[int] = None, conv_id: Optional[str] = None):
+    """
+    return the status of a prepare job (by job_id, or the last one for conv_id)
+    status: queued, running, done, error, superseded
+    """
+    from utils_prepare import prepare_queue
+
+    if job_id is None and conv_id is None:
+        raise HTTPException(status_code=400, detail="job_id or conv_id required.")
+
+    job = prepare_queue.get_job(job_id=job_id, conv_id=conv_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job
 
 
 @app.post("/v2/summarize/", tags=["V2"])
@@ -433,7 +740,8 @@ def summarize_v2(request: MessageSummarize):
     logger.info("Called summarize, language: %s...", request.language)
 
     try:
-        response = handle_summarize_v2(request)
+        with profiler.request("/v2/summarize/", language=request.language):
+            response = handle_summarize_v2(request)
 
         # extract only the text from response
         output = response.content
@@ -456,6 +764,8 @@ def summarize_v2(request: MessageSummarize):
 
 # control ip and port
 if __name__ == "__main__":
+    import uvicorn
+
     print_configuration(app_config)
 
     uvicorn.run(host=app_config["fastapi"]["api_host"], port=app_config["fastapi"]["api_port"], app=app)
@@ -8,6 +8,23 @@ Python Version: 3.11
 from tqdm.auto import tqdm
 from langchain_community.embeddings import OCIGenAIEmbeddings
 
+from utils_resilience import call_with_resilience
+
+
+def latency_key(texts):
+    """
+    the type of the call, for the hedging deadline: the latency depends
+    on the n. of texts (1 for a query, up to 90 for a batch)
+    """
+    n_texts = len(texts)
+
+    if n_texts == 1:
+        return "query"
+    if n_texts <= 16:
+        return "small_batch"
+
+    return "batch"
+
 
 #
 # extend OCIGenAIEmbeddings adding batching
@@ -16,6 +33,9 @@ class OCIGenAIEmbeddingsWithBatch(OCIGenAIEmbeddings):
     """
     add batching to OCIEmebeddings
     with Cohere max # of texts is: 96
+
+    every call to the service goes through the resilience layer
+    (retries, hedging, circuit breaker)
     """
 
     def embed_documents(self, texts):
@@ -28,12 +48,22 @@ class OCIGenAIEmbeddingsWithBatch(OCIGenAIEmbeddings):
             for i in tqdm(range(0, len(texts), batch_size)):
                 batch = texts[i : i + batch_size]
 
-                embeddings_batch = super().embed_documents(batch)
+                embeddings_batch = call_with_resilience(
+                    "embeddings",
+                    super().embed_documents,
+                    batch,
+                    latency_key=latency_key(batch),
+                )
 
                 # add to the final list
                 embeddings.extend(embeddings_batch)
         else:
             # this way we don't display progress bar when we embed a query
-            embeddings = super().embed_documents(texts)
+            embeddings = call_with_resilience(
+                "embeddings",
+                super().embed_documents,
+                texts,
+                latency_key=latency_key(texts),
+            )
 
         return embeddings
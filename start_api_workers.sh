@@ -0,0 +1,2 @@
+# multi-process mode, settings in [workers] in config.toml
+gunicorn -c gunicorn.conf.py main:app
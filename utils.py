@@ -77,6 +77,23 @@ def read_configuration(file_path):
     return config
 
 
+# the configuration shared by all the modules, read only once
+_app_config = {}
+
+
+def get_app_config(file_path="config.toml"):
+    """
+    return the app configuration, the file is read only at the first call
+
+    all the modules get the same dict, so changes made
+    with change_config are seen everywhere
+    """
+    if file_path not in _app_config:
+        _app_config[file_path] = read_configuration(file_path)
+
+    return _app_config[file_path]
+
+
 def print_configuration(config):
     """
     print the configuration used
@@ -0,0 +1,355 @@
+"""
+Admission control for the API
+
+    - token bucket rate limiting per client (IP) or per conv_id prefix,
+      the buckets are shared by the workers (utils_shared_state)
+    - a cap on the work in flight in the worker, with a bounded queue
+    - requests that can't be admitted get a fast 429
+
+the cost of a request is estimated from the endpoint and the size
+of the body (the documents), so a big transcript weighs more than a
+short question. A body without Content-Length (chunked) is charged the
+max size of a body, the cost not used is given back when it has been
+read.
+With more workers the buckets are in files (flock, read, write): they're
+updated in the thread pool, not on the event loop.
+Settings are in the [admission] section of config.toml
+"""
+
+import asyncio
+import time
+from urllib.parse import parse_qs
+
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from utils import get_console_logger
+from utils_shared_state import get_shared_state
+
+logger = get_console_logger()
+
+ONE_MB = 1024 * 1024
+
+
+class TokenBucket:
+    """
+    classic token bucket: rate tokens/sec, max capacity tokens
+    wall clock time, so that the state can be shared by the workers
+    """
+
+    def __init__(self, rate, capacity, tokens=None, last=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else tokens
+        self.last = time.time() if last is None else last
+
+    def _refill(self):
+        now = time.time()
+        elapsed = max(now - self.last, 0.0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last = now
+
+    def try_consume(self, amount):
+        """
+        return (True, 0) if amount tokens have been consumed,
+        (False, sec. to wait) otherwise
+        """
+        self._refill()
+
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True, 0.0
+
+        return False, (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    a token bucket for each key (client or conv_id prefix),
+    saved in the shared state as [tokens, last]
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # an idle bucket is full again after this (and can be removed)
+        self.max_idle = burst / rate
+        self._last_cleanup = time.monotonic()
+
+    def try_acquire(self, key, cost):
+        """
+        return (allowed, retry_after)
+        """
+        # a request bigger than the bucket would never pass
+        cost = min(cost, self.burst)
+        result = []
+
+        def consume(record):
+            bucket = TokenBucket(self.rate, self.burst, *(record or []))
+            result.append(bucket.try_consume(cost))
+
+            return [bucket.tokens, bucket.last]
+
+        get_shared_state().update("bucket:" + key, consume)
+        self._cleanup()
+
+        return result[0]
+
+    def refund(self, key, amount):
+        """
+        give back tokens charged and not used
+        """
+
+        def give_back(record):
+            if record is None:
+                # removed: the bucket is full
+                return None
+
+            tokens, last = record
+
+            return [min(self.burst, tokens + amount), last]
+
+        get_shared_state().update("bucket:" + key, give_back)
+
+    def _cleanup(self):
+        """
+        from time to time, remove the buckets idle (full)
+        """
+        now = time.monotonic()
+        if now - self._last_cleanup < max(self.max_idle, 60.0):
+            return
+
+        self._last_cleanup = now
+        get_shared_state().remove_idle("bucket", self.max_idle)
+
+
+class AdmissionController:
+    """
+    limit on the cost of the requests in flight in the worker
+
+    if there is no capacity the request waits in a bounded queue,
+    for at most queue_timeout sec.
+    """
+
+    def __init__(self, max_inflight_cost, max_queue, queue_timeout):
+        self.max_inflight_cost = max_inflight_cost
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.inflight_cost = 0.0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+
+    def _has_capacity(self, cost):
+        return self.inflight_cost + cost <= self.max_inflight_cost
+
+    async def acquire(self, cost):
+        """
+        return True if the request is admitted
+        """
+        cost = min(cost, self.max_inflight_cost)
+
+        async with self._cond:
+            if self.waiting == 0 and self._has_capacity(cost):
+                self.inflight_cost += cost
+                return True
+
+            if self.waiting >= self.max_queue:
+                # queue full, reject immediately
+                return False
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._has_capacity(cost)),
+                    self.queue_timeout,
+                )
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.waiting -= 1
+
+            self.inflight_cost += cost
+            return True
+
+    async def release(self, cost):
+        """
+        to be called when the request is completed
+        """
+        cost = min(cost, self.max_inflight_cost)
+
+        async with self._cond:
+            self.inflight_cost = max(0.0, self.inflight_cost - cost)
+            self._cond.notify_all()
+
+
+async def _run_shared(func, *args):
+    """
+    run func in the thread pool if the state is in files
+    (blocking I/O), directly if it's in memory
+    """
+    if get_shared_state().shared:
+        return await run_in_threadpool(func, *args)
+
+    return func(*args)
+
+
+def estimate_cost(path, content_length, config, compressed=False):
+    """
+    estimate the cost of a request, in cost units
+    path: without the trailing /
+    content_length: size of the body in bytes, as sent
+    compressed: True if the body is compressed (Content-Encoding), the
+    work depends on the size after decompression, estimated
+    """
+    weight = config["endpoint_weights"].get(path, config["default_weight"])
+
+    size_mb = content_length / ONE_MB
+    if compressed:
+        size_mb *= config["compression_ratio"]
+
+    return weight + size_mb * config["cost_per_mb"]
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying rate limiting and admission control
+    to the paths starting with one of the limited prefixes
+    """
+
+    def __init__(self, app, config, max_body_size):
+        self.app = app
+        self.config = config
+        # bytes, charged to a body without Content-Length
+        self.max_body_size = max_body_size
+
+        self.rate_limiter = RateLimiter(rate=config["rate"], burst=config["burst"])
+        self.admission = AdmissionController(
+            max_inflight_cost=config["max_inflight_cost"],
+            max_queue=config["max_queue"],
+            queue_timeout=config["queue_timeout"],
+        )
+
+    def _client_key(self, scope):
+        """
+        identify the client: conv_id prefix or IP address
+        """
+        if self.config["key_by"] == "conv_id":
+            params = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            conv_id = params.get("conv_id", [""])[0]
+
+            if conv_id:
+                return "conv:" + conv_id[: self.config["conv_id_prefix_len"]]
+
+        client = scope.get("client")
+
+        return "ip:" + (client[0] if client else "unknown")
+
+    async def _reject(self, scope, receive, send, detail, retry_after):
+        response = JSONResponse(
+            status_code=429,
+            content={"detail": detail},
+            headers={"Retry-After": str(max(1, round(retry_after)))},
+        )
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(
+            tuple(self.config["limited_prefixes"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        try:
+            content_length = int(headers.get(b"content-length", 0))
+        except ValueError:
+            content_length = 0
+
+        if b"content-length" not in headers and b"transfer-encoding" in headers:
+            # chunked: charged as the biggest body,
+            # adjusted when the body has been read
+            content_length = None
+
+        content_encoding = headers.get(b"content-encoding", b"identity").strip()
+        compressed = content_encoding.lower() not in (b"", b"identity")
+
+        path = scope["path"].rstrip("/")
+        cost = estimate_cost(
+            path,
+            self.max_body_size if content_length is None else content_length,
+            self.config,
+            compressed=compressed,
+        )
+        key = self._client_key(scope)
+
+        allowed, retry_after = await _run_shared(
+            self.rate_limiter.try_acquire, key, cost
+        )
+        if not allowed:
+            logger.info("Rate limit exceeded for %s, cost: %s", key, round(cost, 1))
+            await self._reject(
+                scope, receive, send, "Rate limit exceeded.", retry_after
+            )
+            return
+
+        if not await self.admission.acquire(cost):
+            logger.info("Server busy, rejected request from %s", key)
+            await self._reject(scope, receive, send, "Server busy, retry later.", 1)
+            return
+
+        if content_length is None:
+            # the cost is known when the body has been read
+            charged = {"cost": cost}
+            received = 0
+
+            async def receive_counted():
+                nonlocal received
+
+                message = await receive()
+
+                if message["type"] == "http.request":
+                    received += len(message.get("body", b""))
+
+                    if not message.get("more_body", False):
+                        await self._adjust_cost(
+                            key,
+                            charged,
+                            estimate_cost(path, received, self.config, compressed),
+                        )
+
+                return message
+
+            try:
+                await self.app(scope, receive_counted, send)
+            finally:
+                await self.admission.release(charged["cost"])
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.admission.release(cost)
+
+    async def _adjust_cost(self, key, charged, cost):
+        """
+        give back the cost charged (max body size) and not used
+        charged: {"cost": ...}, updated
+        """
+        unused = charged["cost"] - cost
+        if unused <= 0:
+            return
+
+        charged["cost"] = cost
+
+        # the amounts actually charged (capped, see acquire)
+        await self.admission.release(
+            min(cost + unused, self.admission.max_inflight_cost)
+            - min(cost, self.admission.max_inflight_cost)
+        )
+        await _run_shared(
+            self.rate_limiter.refund,
+            key,
+            min(cost + unused, self.rate_limiter.burst)
+            - min(cost, self.rate_limiter.burst),
+        )
@@ -0,0 +1,69 @@
+"""
+Utility functions for benchmarks
+
+    - synthetic transcripts of a given size
+    - deterministic fake embeddings (no call to OCI)
+"""
+
+import hashlib
+
+import numpy as np
+
+# dimension of cohere.embed-multilingual-v3.0
+EMBED_DIM = 1024
+
+SPEAKERS = ["Xander", "Lisa Miller", "Luigi", "Anna", "Mark"]
+WORDS = (
+    "policy leave employee meeting project budget customer database cloud "
+    "contract review schedule team report question answer quarter region "
+    "paternity annual days approval manager office travel expense"
+).split()
+
+
+def synthetic_transcript(n_chars, seed=42):
+    """
+    return a meeting like transcript of about n_chars chars
+    """
+    rng = np.random.default_rng(seed)
+
+    lines = []
+    size = 0
+    while size < n_chars:
+        speaker = SPEAKERS[rng.integers(len(SPEAKERS))]
+        n_words = int(rng.integers(8, 60))
+        words = " ".join(WORDS[i] for i in rng.integers(len(WORDS), size=n_words))
+
+        line = f"{speaker}: {words.capitalize()}.\n"
+        if rng.random() < 0.1:
+            # paragraphs
+            line += "\n"
+
+        lines.append(line)
+        size += len(line)
+
+    return "".join(lines)[:n_chars]
+
+
+class FakeEmbeddings:
+    """
+    deterministic embeddings: the vector depends only on the text
+    same interface of the LangChain embeddings used by the API
+    """
+
+    def __init__(self, dim=EMBED_DIM):
+        self.dim = dim
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim)
+
+        return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+    def embed_documents(self, texts):
+        """
+        return a list of vectors (as lists, like the OCI client)
+        """
+        return [self._embed(text).tolist() for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text).tolist()
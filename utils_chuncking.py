@@ -2,36 +2,134 @@
 Utils to handle chunking
 """
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from utils import get_app_config, get_console_logger
 
-from utils import read_configuration, get_console_logger
+app_config = get_app_config()
 
-app_config = read_configuration("config.toml")
 
-
-def get_recursive_text_splitter():
+def get_recursive_text_splitter(add_start_index=False):
     """
     return a recursive text splitter
+    add_start_index: if True chunks have the start offset in metadata
     """
+    # imported here to keep the startup of the API fast
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=app_config["splitting"]["max_chunk_size"],
         chunk_overlap=app_config["splitting"]["chunk_overlap"],
         length_function=len,
         is_separator_regex=False,
+        add_start_index=add_start_index,
     )
     return text_splitter
 
 
+def split_offsets(txt):
+    """
+    split a text, return the offsets (n, 2) of the chunks (start, end)
+    it can run in the process pool (see utils_executor)
+    """
+    import numpy as np
+
+    text_splitter = get_recursive_text_splitter(add_start_index=True)
+
+    offsets = []
+    for doc in text_splitter.create_documents([txt]):
+        chunk_start = doc.metadata["start_index"]
+
+        # -1 if the splitter couldn't find the chunk (shouldn't happen)
+        if chunk_start < 0:
+            chunk_start = txt.find(doc.page_content, offsets[-1][0] if offsets else 0)
+            if chunk_start < 0:
+                raise ValueError("Chunk not found in text")
+
+        offsets.append((chunk_start, chunk_start + len(doc.page_content)))
+
+    return np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+
+
+def split_document(txt, doc_index=0, start=0):
+    """
+    split a single doc, starting from the char in position start
+    (used to re-split only the tail of a growing doc)
+
+    chunks have in metadata:
+        doc_index, start_index and end_index (offsets of the chunk in txt),
+        chunk_id ("doc_index:start_index", stable when the doc grows)
+    the offsets of the chunks are kept in the shared cache,
+    big docs are split in the process pool
+    """
+    from langchain_core.documents import Document
+
+    from utils_executor import run_in_pool, should_offload
+    from utils_shared_cache import get_chunk_offsets, put_chunk_offsets
+
+    tail = txt[start:]
+
+    # maybe already split by another worker
+    offsets = get_chunk_offsets(tail)
+
+    if offsets is None:
+        if should_offload(len(tail), "min_chars"):
+            offsets = run_in_pool(split_offsets, tail)
+        else:
+            offsets = split_offsets(tail)
+
+        put_chunk_offsets(tail, offsets)
+
+    return [
+        Document(
+            page_content=tail[chunk_start:chunk_end],
+            metadata={
+                "chunk_id": f"{doc_index}:{start + chunk_start}",
+                "doc_index": doc_index,
+                "start_index": start + chunk_start,
+                "end_index": start + chunk_end,
+            },
+        )
+        for chunk_start, chunk_end in offsets.tolist()
+    ]
+
+
+def join_documents(txts, max_chars, separator="\n"):
+    """
+    the same as separator.join(txts)[:max_chars], but only the first
+    max_chars are copied (docs can be hundreds of MB)
+    txts: list of docs
+    return (text, True if truncated)
+    """
+    total = sum(len(txt) for txt in txts) + len(separator) * max(len(txts) - 1, 0)
+
+    parts = []
+    size = 0
+
+    for i, txt in enumerate(txts):
+        if size >= max_chars:
+            break
+
+        if i > 0:
+            parts.append(separator)
+            size += len(separator)
+
+        parts.append(txt[: max(max_chars - size, 0)])
+        size += len(parts[-1])
+
+    return "".join(parts)[:max_chars], total > max_chars
+
+
 def split_in_chunks(txts):
     """
     split input text in chunks
-    txts: list of doc to split
+    txts: the docs to split (any iterable, docs are split one at a time)
     """
     logger = get_console_logger()
 
-    text_splitter = get_recursive_text_splitter()
-
-    docs = text_splitter.create_documents(txts)
+    docs = [
+        doc
+        for doc_index, txt in enumerate(txts)
+        for doc in split_document(txt, doc_index)
+    ]
 
     logger.info("splitted in %s chunks...", len(docs))
 
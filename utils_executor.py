@@ -0,0 +1,122 @@
+"""
+Pool of processes for the CPU bound work on big documents
+
+splitting and the encoding of the vectors (int8 quantization, PQ
+training) hold the GIL: done in the request thread they stall the
+other requests of the same worker. For big inputs they're done here.
+
+vectors are passed through shared memory (zero copy),
+not pickled as Python lists.
+Settings are in the [executor] section of config.toml
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """
+    return the pool of processes (created at first use)
+    """
+    global _pool
+
+    config = app_config["executor"]
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=config["num_processes"],
+                mp_context=multiprocessing.get_context(config["start_method"]),
+            )
+            logger.info("Started pool of %s processes", config["num_processes"])
+
+    return _pool
+
+
+def should_offload(size, threshold_name):
+    """
+    True if work of this size must go to the pool
+    threshold_name: the setting in [executor] (min_chars, min_vectors)
+    """
+    config = app_config["executor"]
+
+    return config["enabled"] and size >= config[threshold_name]
+
+
+def run_in_pool(func, *args):
+    """
+    run func in the pool and wait for the result
+    (the calling thread doesn't hold the GIL while waiting)
+    """
+    return get_process_pool().submit(func, *args).result()
+
+
+class SharedVectors:
+    """
+    a float32 matrix in shared memory, to be used as context manager:
+    the segment is released at exit
+    """
+
+    def __init__(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        self.shape = vectors.shape
+        self._shm = SharedMemory(create=True, size=max(vectors.nbytes, 1))
+        self.name = self._shm.name
+
+        self.array = np.ndarray(self.shape, dtype=np.float32, buffer=self._shm.buf)
+        self.array[:] = vectors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # the array must be released before closing the segment
+        del self.array
+        self._shm.close()
+        self._shm.unlink()
+
+
+def attach_shared_vectors(name, shape):
+    """
+    in the pool: attach to the shared vectors
+    return (shm, array), shm must be closed when done
+    """
+    # the segment is owned (and unlinked) by the parent process.
+    # Workers started with forkserver/spawn share the resource tracker
+    # of the parent: the registration done here is the same entry
+    shm = SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+
+
+def warm_process_pool():
+    """
+    start the processes of the pool and import the modules they need
+    """
+    from utils_chuncking import split_offsets
+
+    if not app_config["executor"]["enabled"]:
+        return
+
+    pool = get_process_pool()
+    futures = [
+        pool.submit(split_offsets, "warm-up")
+        for _ in range(app_config["executor"]["num_processes"])
+    ]
+
+    for future in futures:
+        future.result()
@@ -0,0 +1,767 @@
+"""
+In-memory vector index over the chunks of the documents
+
+the vectors can be stored in a compact form:
+    - "none": float32, exact search (as FAISS IndexFlatL2). The vectors
+      are not copied: blocks from the shared cache stay memory mapped
+    - "int8": scalar quantization, 1 byte per dim + a scale per vector
+    - "pq": product quantization with FAISS IndexPQ
+      (needs enough vectors to train, otherwise falls back to int8)
+
+with quantization the full precision vectors are kept out of the heap,
+in a memory mapped temporary file, and used only to rescore the top
+candidates (rescore_factor * k) returned by the compact search.
+PQ is always rescored: alone its recall is too low.
+
+Vectors can be L2 normalized (setting normalize, off by default), so
+L2 distance is equivalent to cosine. For big batches the encoding
+(quantization, PQ training) runs in the process pool (utils_executor).
+
+Chunks can be removed (to handle documents that change): they are
+only marked as deleted and skipped in search, compacted() returns
+a new index without them.
+
+Distances are squared L2, as in FAISS.
+Settings are in the [index] section of config.toml
+
+run this module to get a report (memory per chunk and recall@k
+against the exact float32 search) on synthetic data:
+    python utils_index.py
+"""
+
+import mmap
+import tempfile
+
+import numpy as np
+
+from utils import get_app_config, get_console_logger
+from utils_profiling import span
+from utils_shared_cache import embed_blocks, group_by_document
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+QUANTIZATION_NONE = "none"
+QUANTIZATION_INT8 = "int8"
+QUANTIZATION_PQ = "pq"
+
+# rows processed at once in the int8 search, bounds the temp memory
+INT8_BLOCK_SIZE = 4096
+
+# float32 index: with more blocks than this, the small ones are merged
+FLAT_MAX_BLOCKS = 64
+FLAT_MERGE_ROWS = 1024
+
+
+def normalize_vectors(vectors):
+    """
+    L2 normalize, in place (vectors must be a float32 array)
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.maximum(norms, 1e-12, out=norms)
+    vectors /= norms
+
+    return vectors
+
+
+def quantize_int8(vectors):
+    """
+    symmetric scalar quantization, one scale per vector
+    return codes (int8) and scales (float32)
+    """
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+
+    return codes, scales.astype(np.float32)
+
+
+def _top_n(distances, n):
+    """
+    return the positions of the n smallest distances, sorted
+    """
+    n = min(n, len(distances))
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    idx = np.argpartition(distances, n - 1)[:n]
+
+    return idx[np.argsort(distances[idx])]
+
+
+def is_mapped(array):
+    """
+    True if array is (a view of) a memory mapped file
+    """
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, "base", None)
+
+    return False
+
+
+class FlatBackend:
+    """
+    float32 vectors, exact search
+
+    vectors are kept as a list of blocks, as added: blocks from the
+    shared cache stay memory mapped (shared by the workers, not copied
+    in the heap). Small blocks in the heap are merged.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.blocks = []
+        # position of the first vector of each block
+        self.starts = []
+        self.count = 0
+        self.norms = np.empty(0, dtype=np.float32)
+
+    def add(self, vectors, encoded=None):
+        self.blocks.append(vectors)
+        self.starts.append(self.count)
+        self.count += len(vectors)
+        self.norms = np.concatenate(
+            [self.norms, np.einsum("ij,ij->i", vectors, vectors)]
+        )
+
+        if len(self.blocks) > FLAT_MAX_BLOCKS:
+            self._merge_small_blocks()
+
+    def _merge_small_blocks(self):
+        """
+        merge runs of small blocks (ex: many incremental updates),
+        so that a search is not a loop over hundreds of blocks
+        """
+        blocks, starts = [], []
+        run = []
+
+        for start, block in zip(self.starts, self.blocks):
+            if len(block) < FLAT_MERGE_ROWS:
+                if not run:
+                    starts.append(start)
+                run.append(block)
+                continue
+
+            if run:
+                blocks.append(np.concatenate(run) if len(run) > 1 else run[0])
+                run = []
+
+            starts.append(start)
+            blocks.append(block)
+
+        if run:
+            blocks.append(np.concatenate(run) if len(run) > 1 else run[0])
+
+        self.blocks, self.starts = blocks, starts
+
+    def search(self, query, n):
+        dots = np.empty(self.count, dtype=np.float32)
+
+        for start, block in zip(self.starts, self.blocks):
+            dots[start : start + len(block)] = block @ query
+
+        distances = self.norms - 2 * dots + query @ query
+        ids = _top_n(distances, n)
+
+        return ids, distances[ids]
+
+    def get_vectors(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.empty((len(ids), self.dim), dtype=np.float32)
+
+        positions = np.searchsorted(self.starts, ids, side="right") - 1
+        for i, (block_pos, vector_id) in enumerate(zip(positions, ids)):
+            vectors[i] = self.blocks[block_pos][vector_id - self.starts[block_pos]]
+
+        return vectors
+
+    def live_blocks(self, live_ids):
+        """
+        return the vectors of live_ids (sorted) as views of the blocks,
+        one for each run of consecutive ids (no copy)
+        """
+        live_ids = np.asarray(live_ids, dtype=np.int64)
+        views = []
+
+        for start, block in zip(self.starts, self.blocks):
+            low, high = np.searchsorted(live_ids, [start, start + len(block)])
+            rows = live_ids[low:high] - start
+
+            if len(rows) == 0:
+                continue
+
+            # a new run where the rows are not consecutive
+            breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+            for run in np.split(rows, breaks):
+                views.append(block[run[0] : run[-1] + 1])
+
+        return views
+
+    def memory_bytes(self):
+        # mapped blocks are in the page cache, shared by the workers
+        heap = sum(block.nbytes for block in self.blocks if not is_mapped(block))
+
+        return heap + self.norms.nbytes
+
+
+class Int8Backend:
+    """
+    int8 codes with a scale per vector
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.codes = np.empty((0, dim), dtype=np.int8)
+        self.scales = np.empty(0, dtype=np.float32)
+        # squared norms of the dequantized vectors
+        self.norms = np.empty(0, dtype=np.float32)
+
+    @staticmethod
+    def encode(vectors):
+        """
+        return codes, scales and norms for vectors
+        """
+        codes, scales = quantize_int8(vectors)
+        norms = (codes.astype(np.float32) ** 2).sum(axis=1) * scales**2
+
+        return {"codes": codes, "scales": scales, "norms": norms}
+
+    def add(self, vectors, encoded=None):
+        if encoded is None:
+            encoded = self.encode(vectors)
+
+        self.codes = np.concatenate([self.codes, encoded["codes"]])
+        self.scales = np.concatenate([self.scales, encoded["scales"]])
+        self.norms = np.concatenate([self.norms, encoded["norms"]])
+
+    def search(self, query, n):
+        dots = np.empty(len(self.codes), dtype=np.float32)
+
+        for start in range(0, len(self.codes), INT8_BLOCK_SIZE):
+            block = self.codes[start : start + INT8_BLOCK_SIZE]
+            dots[start : start + len(block)] = block.astype(np.float32) @ query
+
+        distances = self.norms - 2 * dots * self.scales + query @ query
+        ids = _top_n(distances, n)
+
+        return ids, distances[ids]
+
+    def get_vectors(self, ids):
+        return self.codes[ids].astype(np.float32) * self.scales[ids][:, None]
+
+    def memory_bytes(self):
+        return self.codes.nbytes + self.scales.nbytes + self.norms.nbytes
+
+
+class PQBackend:
+    """
+    product quantization with FAISS, trained on the first vectors added
+    """
+
+    def __init__(self, dim, m, nbits):
+        import faiss
+
+        self.index = faiss.IndexPQ(dim, m, nbits)
+
+    @staticmethod
+    def train(vectors, m, nbits):
+        """
+        train an index with vectors and add them
+        return the index serialized (a numpy array of bytes)
+        """
+        import faiss
+
+        index = faiss.IndexPQ(vectors.shape[1], m, nbits)
+        index.train(vectors)
+        index.add(vectors)
+
+        return {"pq_index": faiss.serialize_index(index)}
+
+    def add(self, vectors, encoded=None):
+        import faiss
+
+        if encoded is not None and not self.index.is_trained:
+            # trained (and vectors added) in the process pool
+            self.index = faiss.deserialize_index(encoded["pq_index"])
+            return
+
+        if not self.index.is_trained:
+            self.index.train(vectors)
+
+        self.index.add(vectors)
+
+    def search(self, query, n):
+        distances, ids = self.index.search(query.reshape(1, -1), n)
+        mask = ids[0] >= 0
+
+        return ids[0][mask], distances[0][mask]
+
+    def get_vectors(self, ids):
+        return self.index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+
+    def memory_bytes(self):
+        # codes + the codebooks
+        pq = self.index.pq
+        codebooks = pq.M * pq.ksub * pq.dsub * 4
+
+        return self.index.ntotal * pq.code_size + codebooks
+
+
+class FullPrecisionStore:
+    """
+    float32 vectors in a memory mapped temporary file,
+    read only for rescoring (pages are loaded by the OS when needed)
+    """
+
+    def __init__(self, dim, directory=None):
+        self.dim = dim
+        self.count = 0
+        # deleted when closed (or garbage collected)
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._mmap = None
+
+    def add(self, vectors):
+        self._file.seek(0, 2)
+        self._file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self._file.flush()
+
+        self.count += len(vectors)
+        self._mmap = np.memmap(
+            self._file, dtype=np.float32, mode="r", shape=(self.count, self.dim)
+        )
+
+    def get(self, ids):
+        return np.asarray(self._mmap[ids])
+
+
+class ChunkIndex:
+    """
+    vector index over chunks
+    items: the objects returned by search (normally LangChain Documents)
+    """
+
+    def __init__(
+        self,
+        dim,
+        quantization=QUANTIZATION_NONE,
+        rescore=True,
+        rescore_factor=10,
+        pq_m=128,
+        pq_nbits=8,
+        pq_min_train=10000,
+        rescore_dir=None,
+        normalize=False,
+    ):
+        self.dim = dim
+        self.normalize = normalize
+        self.quantization = quantization
+        # PQ alone has a poor recall (0.34 at 10 on the synthetic data)
+        self.rescore = quantization == QUANTIZATION_PQ or (
+            rescore and quantization != QUANTIZATION_NONE
+        )
+        self.rescore_factor = rescore_factor
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.pq_min_train = pq_min_train
+        self.rescore_dir = rescore_dir
+
+        self.items = []
+        self._deleted = set()
+        self._backend = None
+        self._full = None
+
+    @classmethod
+    def from_config(cls, dim, config=None):
+        """
+        create an index with the settings in [index]
+        """
+        if config is None:
+            config = app_config["index"]
+
+        return cls(
+            dim,
+            quantization=config["quantization"],
+            rescore=config["rescore"],
+            rescore_factor=config["rescore_factor"],
+            pq_m=config["pq_m"],
+            pq_nbits=config["pq_nbits"],
+            pq_min_train=config["pq_min_train"],
+            rescore_dir=config["rescore_dir"] or None,
+            normalize=config["normalize"],
+        )
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def n_deleted(self):
+        """
+        number of chunks removed, but still in the index
+        """
+        return len(self._deleted)
+
+    def _same_settings(self):
+        """
+        return an empty index with the same settings
+        """
+        return ChunkIndex(
+            self.dim,
+            quantization=self.quantization,
+            rescore=self.rescore,
+            rescore_factor=self.rescore_factor,
+            pq_m=self.pq_m,
+            pq_nbits=self.pq_nbits,
+            pq_min_train=self.pq_min_train,
+            rescore_dir=self.rescore_dir,
+            normalize=self.normalize,
+        )
+
+    def _pq_usable(self, n_vectors):
+        """
+        PQ needs enough vectors (in the first batch) to train the codebooks
+        """
+        return self.quantization == QUANTIZATION_PQ and (
+            self._backend is not None or n_vectors >= self.pq_min_train
+        )
+
+    def _create_backend(self, n_vectors):
+        if self.quantization == QUANTIZATION_PQ:
+            if self._pq_usable(n_vectors):
+                return PQBackend(self.dim, self.pq_m, self.pq_nbits)
+
+            logger.info("Too few vectors (%s) for PQ, using int8", n_vectors)
+            self.quantization = QUANTIZATION_INT8
+
+        if self.quantization == QUANTIZATION_INT8:
+            return Int8Backend(self.dim)
+
+        return FlatBackend(self.dim)
+
+    def encode_args(self, n_vectors):
+        """
+        the arguments for encode_vectors, for a batch of n_vectors
+        """
+        return (
+            self.quantization,
+            self._pq_usable(n_vectors),
+            self._backend is None,
+            self.pq_m,
+            self.pq_nbits,
+        )
+
+    def add(self, items, vectors, encoded=None, normalized=False):
+        """
+        add items and their vectors (n, dim)
+        encoded: result of encode_vectors, if done in the pool
+        normalized: True if vectors are already normalized
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+        if len(items) != len(vectors):
+            raise ValueError("items and vectors must have the same length")
+
+        if len(items) == 0:
+            return
+
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"vectors must have shape (n, {self.dim})")
+
+        if self.normalize and not normalized:
+            vectors = normalize_vectors(vectors.copy())
+
+        if self._backend is None:
+            self._backend = self._create_backend(len(vectors))
+
+            if self.rescore:
+                self._full = FullPrecisionStore(self.dim, self.rescore_dir)
+
+        self._backend.add(vectors, encoded)
+        if self._full is not None:
+            self._full.add(vectors)
+
+        self.items.extend(items)
+
+    def remove(self, ids):
+        """
+        mark chunks as deleted, they won't be returned by search
+        """
+        self._deleted.update(int(i) for i in ids)
+
+    def compacted(self):
+        """
+        return a new index without the deleted chunks
+        and the map old id -> new id
+        """
+        live_ids = [i for i in range(len(self)) if i not in self._deleted]
+        id_map = {old_id: new_id for new_id, old_id in enumerate(live_ids)}
+
+        index = self._same_settings()
+        items = [self.items[i] for i in live_ids]
+
+        if isinstance(self._backend, FlatBackend):
+            # views of the blocks, the vectors are not copied
+            position = 0
+            for vectors in self._backend.live_blocks(live_ids):
+                index.add(
+                    items[position : position + len(vectors)], vectors, normalized=True
+                )
+                position += len(vectors)
+        elif live_ids:
+            index.add(items, self.get_vectors(live_ids))
+
+        return index, id_map
+
+    def _drop_deleted(self, ids, distances, k):
+        """
+        remove deleted chunks from results, keep k
+        """
+        if self._deleted:
+            mask = np.array([int(i) not in self._deleted for i in ids], dtype=bool)
+            ids, distances = ids[mask], distances[mask]
+
+        return ids[:k], distances[:k]
+
+    def search_ids(self, query_vector, k):
+        """
+        return ids and distances of the k nearest vectors
+        """
+        if self._backend is None or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        query = np.array(query_vector, dtype=np.float32)
+        if self.normalize:
+            query = normalize_vectors(query.reshape(1, -1))[0]
+
+        # deleted chunks could be in the results, so we ask for more
+        n_search = k + len(self._deleted)
+
+        if self._full is None:
+            ids, distances = self._backend.search(query, min(n_search, len(self)))
+
+            return self._drop_deleted(ids, distances, k)
+
+        # compact search, then rescore the candidates with full precision
+        ids, _ = self._backend.search(
+            query, min(n_search * self.rescore_factor, len(self))
+        )
+
+        distances = ((self._full.get(ids) - query) ** 2).sum(axis=1)
+        order = np.argsort(distances)
+
+        return self._drop_deleted(ids[order], distances[order], k)
+
+    def search(self, query_vector, k):
+        """
+        return a list of (item, distance), as LangChain
+        similarity_search_with_score
+        """
+        ids, distances = self.search_ids(query_vector, k)
+
+        return [(self.items[i], float(d)) for i, d in zip(ids, distances)]
+
+    def get_vectors(self, ids):
+        """
+        return the vectors for ids (full precision if available)
+        """
+        if self._full is not None:
+            return self._full.get(ids)
+
+        return self._backend.get_vectors(ids)
+
+    def memory_bytes(self):
+        """
+        memory (heap) used by the vectors
+        """
+        if self._backend is None:
+            return 0
+
+        return self._backend.memory_bytes()
+
+    def memory_per_chunk(self):
+        """
+        average bytes per chunk (live or deleted)
+        """
+        return self.memory_bytes() / len(self) if len(self) > 0 else 0.0
+
+    def rescore_bytes(self):
+        """
+        size of the full precision vectors kept for rescoring:
+        not in the heap, but in a temp file (page cache when used)
+        """
+        return 0 if self._full is None else self._full.count * self.dim * 4
+
+
+def encode_vectors(vectors, quantization, pq_usable, first_batch, pq_m, pq_nbits):
+    """
+    quantize vectors (or train PQ), return the data for Backend.add
+    it is a plain function, so that it can run in the process pool
+    """
+    if quantization == QUANTIZATION_PQ and pq_usable:
+        # PQ is trained on the first batch, later adds are cheap
+        return PQBackend.train(vectors, pq_m, pq_nbits) if first_batch else None
+
+    if quantization in (QUANTIZATION_INT8, QUANTIZATION_PQ):
+        return Int8Backend.encode(vectors)
+
+    return None
+
+
+def _prepare_in_pool(shm_name, shape, normalize, encode_args):
+    """
+    runs in the process pool: normalize the shared vectors (in place)
+    and encode them
+    """
+    from utils_executor import attach_shared_vectors
+
+    shm, vectors = attach_shared_vectors(shm_name, shape)
+
+    try:
+        if normalize:
+            normalize_vectors(vectors)
+
+        encoded = encode_vectors(vectors, *encode_args)
+    finally:
+        del vectors
+        shm.close()
+
+    return encoded
+
+
+def add_to_index(index, items, vectors):
+    """
+    add items and vectors to index, for big batches the encoding
+    (int8, PQ) and the normalization are done in the process pool
+    vectors: an array, or a list of blocks (arrays) with the vectors
+    of items in order
+    """
+    from utils_executor import SharedVectors, run_in_pool, should_offload
+
+    if isinstance(vectors, list):
+        if index.quantization == QUANTIZATION_NONE:
+            # the blocks are kept as they are (memory mapped, if from the cache)
+            position = 0
+            for block in vectors:
+                index.add(items[position : position + len(block)], block)
+                position += len(block)
+            return
+
+        vectors = np.concatenate(vectors) if vectors else np.empty((0, index.dim))
+
+    # float32 vectors are not encoded: the copy to shared memory and the
+    # round trip to the pool cost more than normalizing them here
+    if index.quantization == QUANTIZATION_NONE or not should_offload(
+        len(vectors), "min_vectors"
+    ):
+        index.add(items, vectors)
+        return
+
+    with SharedVectors(vectors) as shared:
+        encoded = run_in_pool(
+            _prepare_in_pool,
+            shared.name,
+            shared.shape,
+            index.normalize,
+            index.encode_args(len(vectors)),
+        )
+
+        index.add(items, shared.array, encoded=encoded, normalized=True)
+
+
+def build_chunk_index(docs, embed_model):
+    """
+    embed the docs (LangChain Documents) and build the index
+    """
+    # vectors already computed (by any worker) are in the shared cache,
+    # a block for the chunks of each document
+    with span("embed"):
+        blocks = [
+            vectors for _, vectors in embed_blocks(embed_model, group_by_document(docs))
+        ]
+
+    with span("index"):
+        index = ChunkIndex.from_config(blocks[0].shape[1] if blocks else 0)
+        add_to_index(index, docs, blocks)
+
+    if app_config["general"]["verbose"]:
+        logger.info(
+            "Index (%s): %s chunks, %s bytes per chunk",
+            index.quantization,
+            len(index),
+            round(index.memory_per_chunk()),
+        )
+
+    return index
+
+
+def evaluate_quantization(vectors, queries, k=10, **index_kwargs):
+    """
+    compare a quantized index with the exact float32 search
+    return memory per chunk and recall@k
+    """
+    exact = ChunkIndex(vectors.shape[1])
+    exact.add(list(range(len(vectors))), vectors)
+
+    approx = ChunkIndex(vectors.shape[1], **index_kwargs)
+    approx.add(list(range(len(vectors))), vectors)
+
+    hits = 0
+    for query in queries:
+        exact_ids, _ = exact.search_ids(query, k)
+        approx_ids, _ = approx.search_ids(query, k)
+
+        hits += len(set(exact_ids.tolist()) & set(approx_ids.tolist()))
+
+    return {
+        "quantization": approx.quantization,
+        "rescore": approx.rescore,
+        "bytes_per_chunk": round(approx.memory_per_chunk(), 1),
+        # the float32 copy used to rescore, in the memory mapped file
+        "rescore_file_bytes_per_chunk": round(approx.rescore_bytes() / len(approx), 1),
+        "float32_bytes_per_chunk": round(exact.memory_per_chunk(), 1),
+        f"recall@{k}": round(hits / (len(queries) * k), 4),
+    }
+
+
+def _synthetic_embeddings(n_vectors, dim, n_topics=64, seed=42):
+    """
+    normalized vectors grouped in topics, roughly like text embeddings
+    """
+    rng = np.random.default_rng(seed)
+
+    topics = rng.standard_normal((n_topics, dim)).astype(np.float32)
+    vectors = topics[rng.integers(0, n_topics, n_vectors)]
+    vectors = vectors + 0.8 * rng.standard_normal((n_vectors, dim)).astype(np.float32)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+if __name__ == "__main__":
+    # dimension of cohere.embed-multilingual-v3.0
+    DIM = 1024
+    N_CHUNKS = 12000
+    K = 10
+
+    data = _synthetic_embeddings(N_CHUNKS + 100, DIM)
+    chunk_vectors, query_vectors = data[:N_CHUNKS], data[N_CHUNKS:]
+
+    # the settings in [index] (PQ is always rescored)
+    config = app_config["index"]
+    settings = {
+        "rescore_factor": config["rescore_factor"],
+        "pq_m": config["pq_m"],
+        "pq_nbits": config["pq_nbits"],
+    }
+    print(settings)
+
+    for kwargs in [
+        {"quantization": QUANTIZATION_INT8, "rescore": False},
+        {"quantization": QUANTIZATION_INT8, "rescore": True},
+        {"quantization": QUANTIZATION_PQ, "rescore": True},
+    ]:
+        print(
+            evaluate_quantization(chunk_vectors, query_vectors, K, **kwargs, **settings)
+        )
@@ -0,0 +1,651 @@
+"""
+Cache of the indexes of the conversations, with incremental updates
+
+the typical workload is a transcript that keeps growing: at every turn
+the client sends again the full documents, with a few new paragraphs.
+For every document we keep the text and the chunks of the previous
+request; when the new text shares a prefix with the old one:
+    - chunks fully inside the unchanged prefix are kept
+      (but the last one, that could be extended by the new text)
+    - only the tail is re-split
+    - only the new chunks are embedded and added to the index
+    - the chunks replaced are removed from the index
+
+so the cost of a turn depends on the new text, not on the whole transcript.
+
+with more workers (utils_shared_state) the requests of a conversation
+can go to any worker. The vectors are in blocks of the shared cache and
+the layout of the index is a shared record: for every document the
+blocks (segments) with its chunks, and the sha1 of the text up to the
+end of each segment. A worker with an old version of the index rebuilds
+it from the layout: the segments still valid for the new text (same
+hash) are loaded from the mapped blocks, nothing is embedded again.
+The conversation is locked for all the workers during an update.
+
+every conversation keeps its documents and the text of its chunks (about
+twice the transcript): the cache is bounded in conversations and in
+chars kept (max_cached_mb), the least recently used are removed.
+Settings are in the [index_cache] section of config.toml
+"""
+
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+from utils import get_app_config, get_console_logger
+from utils_chuncking import split_document
+from utils_index import ChunkIndex, add_to_index
+from utils_profiling import span
+from utils_shared_cache import (
+    embed_blocks,
+    get_block,
+    get_shared_cache,
+    group_by_document,
+)
+from utils_shared_state import get_shared_state
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+# to find the common prefix we compare blocks of chars
+PREFIX_BLOCK_SIZE = 64 * 1024
+
+# multi-worker mode: max n. of chunks in a segment of the layout
+SEGMENT_ROWS = 64
+
+
+def common_prefix_len(old, new):
+    """
+    return the length of the common prefix of two strings
+    block comparisons are done in C, so it is fast also for MB of text
+    """
+    n = min(len(old), len(new))
+
+    pos = 0
+    while (
+        pos < n
+        and old[pos : pos + PREFIX_BLOCK_SIZE] == new[pos : pos + PREFIX_BLOCK_SIZE]
+    ):
+        pos += PREFIX_BLOCK_SIZE
+
+    if pos >= n:
+        return n
+
+    # the first difference is in this block, binary search
+    block_old = old[pos : pos + PREFIX_BLOCK_SIZE]
+    block_new = new[pos : pos + PREFIX_BLOCK_SIZE]
+
+    low, high = 0, min(len(block_old), len(block_new))
+    while low < high:
+        mid = (low + high + 1) // 2
+
+        if block_old[:mid] == block_new[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+
+    return pos + low
+
+
+def _hash_to(hasher, text, start, end):
+    """
+    return a new sha1: hasher (of text[:start], None if start is 0)
+    updated with text[start:end]
+    """
+    hasher = hashlib.sha1() if hasher is None else hasher.copy()
+    hasher.update(text[start:end].encode("utf-8", errors="surrogatepass"))
+
+    return hasher
+
+
+class DocumentState:
+    """
+    what we know of a document from the previous request
+    """
+
+    def __init__(self):
+        self.text = ""
+        # ids in the index of the chunks and their offsets in text
+        self.chunk_ids = []
+        self.chunk_starts = []
+        self.chunk_ends = []
+        # multi-worker mode: the blocks with the vectors of the chunks
+        # (key, base, rows, end, hash) and the sha1 of text[:end]
+        self.segments = []
+        self.hashers = []
+
+    def update_segments(self, text, n_kept, docs, key):
+        """
+        segments for the n_kept chunks kept and the new chunks (docs),
+        whose vectors are in the block key. Called before the update
+        of the chunk offsets
+        """
+        segments, hashers = [], []
+        rows = 0
+
+        for segment, hasher in zip(self.segments, self.hashers):
+            if rows + segment["rows"] <= n_kept:
+                segments.append(segment)
+                hashers.append(hasher)
+                rows += segment["rows"]
+                continue
+
+            # the segment is partially kept
+            if n_kept > rows:
+                end = self.chunk_ends[n_kept - 1]
+                hasher = _hash_to(
+                    hashers[-1] if hashers else None,
+                    text,
+                    segments[-1]["end"] if segments else 0,
+                    end,
+                )
+                segments.append(
+                    {
+                        **segment,
+                        "rows": n_kept - rows,
+                        "end": end,
+                        "hash": hasher.hexdigest(),
+                    }
+                )
+                hashers.append(hasher)
+            break
+
+        # the new chunks, a segment every SEGMENT_ROWS: if the text
+        # changes only the segments after the change are lost
+        for base in range(0, len(docs), SEGMENT_ROWS):
+            rows = docs[base : base + SEGMENT_ROWS]
+
+            start = segments[-1]["end"] if segments else 0
+            end = max(rows[-1].metadata["end_index"], start)
+            hasher = _hash_to(hashers[-1] if hashers else None, text, start, end)
+
+            segments.append(
+                {
+                    "key": key,
+                    "base": base,
+                    "rows": len(rows),
+                    "end": end,
+                    "hash": hasher.hexdigest(),
+                }
+            )
+            hashers.append(hasher)
+
+        self.segments, self.hashers = segments, hashers
+
+    def to_layout(self):
+        """
+        the record of the document for the other workers
+        """
+        hasher = _hash_to(
+            self.hashers[-1] if self.hashers else None,
+            self.text,
+            self.segments[-1]["end"] if self.segments else 0,
+            len(self.text),
+        )
+
+        return {
+            "length": len(self.text),
+            "hash": hasher.hexdigest(),
+            "segments": self.segments,
+        }
+
+    @classmethod
+    def from_layout(cls, doc_index, text, layout, items, blocks):
+        """
+        the state of a document from its layout: only the segments
+        still valid for text are used, their chunks are added to
+        items and their vectors (mapped) to blocks
+        """
+        from langchain_core.documents import Document
+
+        state = cls()
+        hasher = None
+        position = 0
+        # segments of the same block
+        loaded = {}
+
+        for segment in layout["segments"]:
+            if segment["end"] > len(text):
+                break
+
+            hasher = _hash_to(hasher, text, position, segment["end"])
+            position = segment["end"]
+
+            if hasher.hexdigest() != segment["hash"]:
+                break
+
+            if segment["key"] not in loaded:
+                loaded[segment["key"]] = get_block(segment["key"])
+
+            block = loaded[segment["key"]]
+            if block is None:
+                break
+
+            vectors, offsets = block
+            rows = slice(segment["base"], segment["base"] + segment["rows"])
+
+            blocks.append(vectors[rows])
+            for start, end in offsets[rows].tolist():
+                items.append(
+                    Document(
+                        page_content=text[start:end],
+                        metadata={
+                            "chunk_id": f"{doc_index}:{start}",
+                            "doc_index": doc_index,
+                            "start_index": start,
+                            "end_index": end,
+                        },
+                    )
+                )
+                state.chunk_starts.append(start)
+                state.chunk_ends.append(end)
+
+            state.segments.append(segment)
+            state.hashers.append(hasher)
+
+        state.text = text
+        if state.to_layout()["hash"] != layout["hash"]:
+            # changed: as if the old text were the valid prefix
+            state.text = text[: state.segments[-1]["end"] if state.segments else 0]
+
+        return state
+
+
+class ConversationIndex:
+    """
+    the index of a conversation and the state of its documents
+    shared: the layout is published for the other workers
+    """
+
+    def __init__(self, conv_id=None, shared=False):
+        self.index = None
+        self.documents = []
+        self.lock = threading.Lock()
+
+        self.shared = shared
+        self.key = f"index:{conv_id}"
+        # of the layout this index corresponds to
+        self.version = None
+        self.record_version = None
+
+    def _plan_document(self, doc_index, text):
+        """
+        decide which chunks to keep and split the changed part of a doc
+        return (n. of chunks kept, new chunks)
+        """
+        if doc_index >= len(self.documents):
+            return 0, split_document(text, doc_index)
+
+        state = self.documents[doc_index]
+
+        if state.text == text:
+            return len(state.chunk_ids), []
+
+        prefix_len = common_prefix_len(state.text, text)
+
+        # keep the chunks that end inside the unchanged prefix,
+        # the last chunk is always re-split (the new text could extend it)
+        n_kept = 0
+        while (
+            n_kept < len(state.chunk_ids) - 1 and state.chunk_ends[n_kept] <= prefix_len
+        ):
+            n_kept += 1
+
+        # re-split from the start of the first chunk not kept, but not
+        # after the end of the prefix: the text changed could be before
+        # that chunk (ex: in the whitespace between two chunks)
+        if n_kept == 0:
+            start = 0
+        else:
+            start = min(state.chunk_starts[n_kept], prefix_len)
+
+        return n_kept, split_document(text, doc_index, start)
+
+    def update(self, texts, embed_model):
+        """
+        bring the index up to date with texts (the documents of the request)
+        return the index
+        """
+        if self.shared:
+            with span("index"):
+                self._sync(texts)
+
+        with span("split"):
+            plans = [self._plan_document(i, text) for i, text in enumerate(texts)]
+
+        new_docs = [doc for _, docs in plans for doc in docs]
+
+        # embed only the new chunks and add them to the index.
+        # If it fails the state of the documents is unchanged
+        index = self.index
+        keys = {}
+        if new_docs:
+            # a block for the new chunks of each document
+            blocks = group_by_document(new_docs)
+
+            with span("embed"):
+                embedded = embed_blocks(embed_model, blocks)
+
+            if index is None:
+                index = ChunkIndex.from_config(embedded[0][1].shape[1])
+
+            next_id = len(index)
+
+            with span("index"):
+                add_to_index(index, new_docs, [vectors for _, vectors in embedded])
+
+            keys = {
+                block[0].metadata["doc_index"]: key
+                for block, (key, _) in zip(blocks, embedded)
+            }
+        else:
+            next_id = len(index) if index is not None else 0
+
+        self.index = index
+
+        removed = []
+        n_kept_total = 0
+
+        for doc_index, (text, (n_kept, docs)) in enumerate(zip(texts, plans)):
+            if doc_index >= len(self.documents):
+                self.documents.append(DocumentState())
+
+            state = self.documents[doc_index]
+            removed.extend(state.chunk_ids[n_kept:])
+            n_kept_total += n_kept
+
+            if self.shared:
+                state.update_segments(text, n_kept, docs, keys.get(doc_index))
+
+            state.text = text
+            state.chunk_ids = state.chunk_ids[:n_kept] + list(
+                range(next_id, next_id + len(docs))
+            )
+            state.chunk_starts = state.chunk_starts[:n_kept] + [
+                doc.metadata["start_index"] for doc in docs
+            ]
+            state.chunk_ends = state.chunk_ends[:n_kept] + [
+                doc.metadata["end_index"] for doc in docs
+            ]
+            next_id += len(docs)
+
+        # documents no longer in the request
+        for state in self.documents[len(texts) :]:
+            removed.extend(state.chunk_ids)
+        del self.documents[len(texts) :]
+
+        if self.index is not None:
+            with span("index"):
+                if removed:
+                    self.index.remove(removed)
+
+                self._maybe_compact()
+
+        if self.shared:
+            self._publish()
+
+        logger.info(
+            "Index update: %s chunks kept, %s new, %s removed",
+            n_kept_total,
+            len(new_docs),
+            len(removed),
+        )
+
+        return self.index
+
+    def _sync(self, texts):
+        """
+        if another worker has updated the index, rebuild it from the layout
+        """
+        state = get_shared_state()
+
+        record_version = state.version(self.key)
+        if record_version is not None and record_version == self.record_version:
+            return
+
+        record = state.get(self.key)
+        version = None if record is None else record["version"]
+
+        if version != self.version:
+            if record is None:
+                # deleted by another worker
+                self.index, self.documents = None, []
+            else:
+                self._load(texts, record["documents"])
+
+                logger.info("%s loaded from the shared layout", self.key)
+
+        self.version = version
+        self.record_version = record_version
+
+    def _load(self, texts, layouts):
+        """
+        rebuild the index and the documents from the layouts
+        """
+        items, blocks = [], []
+
+        self.documents = [
+            DocumentState.from_layout(doc_index, text, layout, items, blocks)
+            for doc_index, (text, layout) in enumerate(zip(texts, layouts))
+        ]
+
+        chunk_id = 0
+        for doc_state in self.documents:
+            n_chunks = len(doc_state.chunk_starts)
+            doc_state.chunk_ids = list(range(chunk_id, chunk_id + n_chunks))
+            chunk_id += n_chunks
+
+        self.index = None
+        if blocks:
+            self.index = ChunkIndex.from_config(blocks[0].shape[1])
+            add_to_index(self.index, items, blocks)
+
+    def _publish(self):
+        """
+        save the layout for the other workers
+        """
+        state = get_shared_state()
+
+        self.version = uuid.uuid4().hex
+        state.put(
+            self.key,
+            {
+                "version": self.version,
+                "documents": [doc_state.to_layout() for doc_state in self.documents],
+            },
+        )
+        self.record_version = state.version(self.key)
+
+    def n_chars(self):
+        """
+        chars kept: the documents and the chunks in the index
+        """
+        return sum(
+            len(state.text) + sum(state.chunk_ends) - sum(state.chunk_starts)
+            for state in self.documents
+        )
+
+    def _maybe_compact(self):
+        """
+        rebuild the index if there are too many deleted chunks
+        """
+        max_deleted = app_config["index_cache"]["compact_ratio"] * len(self.index)
+
+        if self.index.n_deleted <= max_deleted:
+            return
+
+        self.index, id_map = self.index.compacted()
+
+        for state in self.documents:
+            state.chunk_ids = [id_map[i] for i in state.chunk_ids]
+
+
+class IndexCache:
+    """
+    LRU cache: conv_id -> ConversationIndex
+    bounded in n. of conversations and in chars kept
+    """
+
+    def __init__(self, max_conversations, max_chars):
+        self.max_conversations = max_conversations
+        self.max_chars = max_chars
+        self._conversations = OrderedDict()
+        # conv_id -> chars, after the last update
+        self._sizes = {}
+        self._total_chars = 0
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        """
+        remove the least recently used, with the lock held
+        """
+        while self._conversations and (
+            len(self._conversations) > self.max_conversations
+            or self._total_chars > self.max_chars
+        ):
+            conv_id, _ = self._conversations.popitem(last=False)
+            self._total_chars -= self._sizes.pop(conv_id, 0)
+
+    def _resize(self, conv_id, conv):
+        """
+        update the chars of a conversation, after a request
+        """
+        n_chars = conv.n_chars()
+
+        with self._lock:
+            # removed (or replaced) while it was in use
+            if self._conversations.get(conv_id) is not conv:
+                return
+
+            self._total_chars += n_chars - self._sizes.get(conv_id, 0)
+            self._sizes[conv_id] = n_chars
+
+            self._evict()
+
+    def _get(self, conv_id):
+        with self._lock:
+            conv = self._conversations.get(conv_id)
+
+            if conv is None:
+                # with more workers, and the vectors in the shared cache
+                shared = get_shared_state().shared and get_shared_cache() is not None
+
+                conv = ConversationIndex(conv_id, shared)
+                self._conversations[conv_id] = conv
+
+            self._conversations.move_to_end(conv_id)
+
+            self._evict()
+
+        return conv
+
+    @contextmanager
+    def conversation(self, conv_id):
+        """
+        return the ConversationIndex for conv_id, locked
+        (requests for the same conversation are serialized,
+        also between workers)
+        """
+        conv = self._get(conv_id)
+
+        shared_lock = (
+            get_shared_state().lock(conv.key) if conv.shared else nullcontext()
+        )
+
+        with conv.lock, shared_lock:
+            try:
+                yield conv
+            finally:
+                self._resize(conv_id, conv)
+
+    def drop(self, conv_id):
+        """
+        remove a conversation from cache (and its layout)
+        """
+        with self._lock:
+            self._conversations.pop(conv_id, None)
+            self._total_chars -= self._sizes.pop(conv_id, 0)
+
+        get_shared_state().delete(f"index:{conv_id}")
+
+
+index_cache = IndexCache(
+    app_config["index_cache"]["max_conversations"],
+    app_config["index_cache"]["max_cached_mb"] * 1024 * 1024,
+)
+
+
+if __name__ == "__main__":
+    # regression checks, with fake embeddings (OCI is not called):
+    #     python utils_index_cache.py
+    from utils_bench import FakeEmbeddings
+
+    app_config["shared_cache"]["enabled"] = False
+
+    def live_texts(conv):
+        """
+        the text of the chunks in the index, not deleted
+        """
+        index = conv.index
+
+        return [
+            index.items[i].page_content
+            for i in range(len(index))
+            if i not in index._deleted
+        ]
+
+    # the changed text is before the first chunk (leading whitespace)
+    conv = ConversationIndex()
+    conv.update(["\n\n\n   hello world, this is the old text"], FakeEmbeddings())
+    conv.update(["XYZ START bye world, this is the new text"], FakeEmbeddings())
+    assert live_texts(conv) == ["XYZ START bye world, this is the new text"]
+
+    # the change is in the whitespace between two chunks
+    paragraph = "Lisa Miller: " + "the policy covers paternity leave. " * 40
+    old_text = paragraph + "\n\n\n\n" + paragraph
+    new_text = paragraph + "\n\nNEW\n" + paragraph
+
+    conv = ConversationIndex()
+    conv.update([old_text], FakeEmbeddings())
+    conv.update([new_text], FakeEmbeddings())
+    assert any("NEW" in text for text in live_texts(conv))
+
+    class FailingEmbeddings(FakeEmbeddings):
+        """
+        vectors of the wrong size: adding them to the index fails
+        """
+
+        def embed_documents(self, texts):
+            return [vector[:10] for vector in super().embed_documents(texts)]
+
+    # if the index can't be updated the state is unchanged
+    conv = ConversationIndex()
+    conv.update([old_text], FakeEmbeddings())
+    before = [list(state.chunk_ids) for state in conv.documents]
+
+    try:
+        conv.update([old_text + "\n\nAnna: new text.", old_text], FailingEmbeddings())
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("the update should fail")
+
+    assert [list(state.chunk_ids) for state in conv.documents] == before
+    conv.index.compacted()
+    conv.update([old_text + "\n\nAnna: new text."], FakeEmbeddings())
+    assert "Anna: new text." in live_texts(conv)[-1]
+
+    # bounded in chars: the least recently used is removed
+    cache = IndexCache(max_conversations=10, max_chars=3 * len(old_text))
+
+    for conv_id in ("a", "b", "c"):
+        with cache.conversation(conv_id) as conv:
+            conv.update([old_text], FakeEmbeddings())
+
+    assert list(cache._conversations) == ["c"]
+    assert cache._total_chars == cache._conversations["c"].n_chars()
+
+    print("OK")
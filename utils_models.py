@@ -0,0 +1,70 @@
+"""
+Factory for the models (chat and embeddings)
+
+clients are created once and reused by all the requests,
+so that we don't pay for client creation (and TLS handshake)
+on every call
+"""
+
+import threading
+
+from utils import get_app_config
+
+app_config = get_app_config()
+
+_chat_models = {}
+_embed_models = {}
+_models_lock = threading.Lock()
+
+
+def get_chat_model(model_id=None):
+    """
+    return an instance of Chat Model (cached)
+    model_id: if None, the one in config
+    """
+    if model_id is None:
+        model_id = app_config["oci"]["model_id"]
+
+    temperature = app_config["llm"]["temperature"]
+    max_tokens = app_config["llm"]["max_tokens"]
+    key = (model_id, temperature, max_tokens)
+
+    with _models_lock:
+        if key not in _chat_models:
+            # heavy import, done only when needed
+            from langchain_community.chat_models.oci_generative_ai import (
+                ChatOCIGenAI,
+            )
+
+            _chat_models[key] = ChatOCIGenAI(
+                auth_type=app_config["oci"]["auth"],
+                model_id=model_id,
+                service_endpoint=app_config["oci"]["endpoint"],
+                compartment_id=app_config["oci"]["compartment_ocid"],
+                model_kwargs={
+                    "temperature": temperature,
+                    "max_tokens": max_tokens,
+                },
+            )
+
+    return _chat_models[key]
+
+
+def get_embedding_model():
+    """
+    return an instance of Embedding Model (cached)
+    """
+    model_id = app_config["embeddings"]["model_id"]
+
+    with _models_lock:
+        if model_id not in _embed_models:
+            from oci_cohere_embeddings_utils import OCIGenAIEmbeddingsWithBatch
+
+            _embed_models[model_id] = OCIGenAIEmbeddingsWithBatch(
+                auth_type=app_config["oci"]["auth"],
+                model_id=model_id,
+                service_endpoint=app_config["embeddings"]["embed_endpoint"],
+                compartment_id=app_config["oci"]["compartment_ocid"],
+            )
+
+    return _embed_models[model_id]
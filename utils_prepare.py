@@ -0,0 +1,324 @@
+"""
+Background preparation of the documents of a conversation
+
+clients know the documents before the first question: with prepare the
+documents are split, embedded and indexed in background, so that the
+first answer only waits for the LLM.
+
+    - a priority queue, served by a bounded number of worker threads
+    - for a conversation only the last documents sent are prepared:
+      a job still in the queue is superseded by a newer one
+    - an answer arriving while the job is running waits for it (join,
+      the conversation is locked by the job in all the workers) and then
+      finds the work done: the index in the index cache, or (without the
+      index cache) the embeddings in the shared cache. An answer arriving
+      before the job starts does the work and the job is superseded
+    - the documents wait in memory: the queue of a worker is bounded in
+      jobs (max_queue) and in size (max_queued_mb), over it 429
+    - with more workers the status of the jobs is shared
+      (utils_shared_state): it can be read, and a job superseded,
+      from any worker. Jobs run in the worker that received them
+
+Settings are in the [prepare] section of config.toml
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+
+from utils import get_app_config, get_console_logger
+from utils_shared_state import get_shared_state
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class QueueFullError(Exception):
+    """
+    the prepare queue is full
+    """
+
+
+class PrepareJob:
+    """
+    the preparation of the documents of a conversation
+    """
+
+    def __init__(self, job_id, conv_id, documents, priority):
+        self.job_id = job_id
+        self.conv_id = conv_id
+        self.documents = documents
+        # chars of the documents, while they're in the queue
+        self.size = sum(len(document) for document in documents)
+        self.priority = priority
+        self.status = "queued"
+        self.n_chunks = None
+        self.error = None
+        self.time_queued = time.time()
+        self.time_start = None
+        self.time_end = None
+
+    def to_dict(self):
+        """
+        for the status endpoint
+        """
+        return {
+            "job_id": self.job_id,
+            "conv_id": self.conv_id,
+            "status": self.status,
+            "priority": self.priority,
+            "n_chunks": self.n_chunks,
+            "error": self.error,
+            "time_queued": self.time_queued,
+            "time_start": self.time_start,
+            "time_end": self.time_end,
+            "worker_pid": os.getpid(),
+        }
+
+
+def prepare_documents(conv_id, documents):
+    """
+    split, embed and index the documents of a conversation
+    return the n. of chunks
+    """
+    from utils_models import get_embedding_model
+
+    embed_model = get_embedding_model()
+
+    if app_config["index_cache"]["enabled"]:
+        from utils_index_cache import index_cache
+
+        with index_cache.conversation(conv_id) as conv:
+            index = conv.update(documents, embed_model)
+
+        return 0 if index is None else len(index) - index.n_deleted
+
+    # no index per conversation: the chunks and their embeddings
+    # are kept in the shared cache, and used by the answer
+    from utils_chuncking import split_in_chunks
+    from utils_shared_cache import embed_blocks, group_by_document
+
+    docs = split_in_chunks(documents)
+    embed_blocks(embed_model, group_by_document(docs))
+
+    return len(docs)
+
+
+def _job_key(job_id):
+    return f"prepare_job:{job_id}"
+
+
+def _conv_key(conv_id):
+    return f"prepare_conv:{conv_id}"
+
+
+class PrepareQueue:
+    """
+    priority queue of PrepareJob, served by worker threads
+    the status of the jobs is in the shared state
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._queue = queue.PriorityQueue()
+        # FIFO for jobs with the same priority
+        self._counter = itertools.count()
+
+        # jobs of this worker in the queue, and the chars of their documents
+        self._queued = {}
+        self._queued_chars = 0
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _start_workers(self):
+        """
+        start the worker threads (at first use), with the lock held
+        """
+        if self._workers:
+            return
+
+        for i in range(self.config["num_workers"]):
+            worker = threading.Thread(
+                target=self._work, name=f"prepare-{i}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    @staticmethod
+    def _change_status(job_id, status, only_from=None, **fields):
+        """
+        change the status of the job (if it's only_from)
+        return True if changed
+        """
+        changed = []
+
+        def change(record):
+            if record is None or (only_from and record["status"] != only_from):
+                return record
+
+            changed.append(True)
+
+            return {**record, "status": status, **fields}
+
+        get_shared_state().update(_job_key(job_id), change)
+
+        return bool(changed)
+
+    def _release(self, job):
+        """
+        free the documents of a job (done or superseded), with the lock held
+        """
+        self._queued_chars -= job.size
+        job.size = 0
+        job.documents = None
+
+    def _save(self, job):
+        get_shared_state().put(_job_key(job.job_id), job.to_dict())
+
+    def submit(self, conv_id, documents, priority="normal"):
+        """
+        queue the preparation of documents for conv_id
+        return the job
+        """
+        state = get_shared_state()
+        size = sum(len(document) for document in documents)
+        max_chars = self.config["max_queued_mb"] * 1024 * 1024
+
+        with self._lock:
+            # the documents wait in memory: bounded n. of jobs and size
+            if (
+                len(self._queued) >= self.config["max_queue"]
+                or self._queued_chars + size > max_chars
+            ):
+                raise QueueFullError("Too many documents waiting for preparation")
+
+            self._start_workers()
+
+        # ids unique for all the workers
+        job_id = state.update("prepare:last_job_id", lambda last: (last or 0) + 1)
+        job = PrepareJob(job_id, conv_id, documents, priority)
+        self._save(job)
+
+        # only the last documents of a conversation are prepared
+        self.supersede(conv_id)
+        state.put(_conv_key(conv_id), job_id)
+
+        # the status of the old jobs is not kept
+        state.delete(_job_key(job_id - self.config["max_jobs"]))
+
+        with self._lock:
+            self._queued[job_id] = job
+            self._queued_chars += job.size
+            self._queue.put((PRIORITIES[priority], next(self._counter), job))
+
+        return job
+
+    def supersede(self, conv_id):
+        """
+        called by a new job: a job still in the queue for conv_id,
+        in any worker, is not needed anymore
+        """
+        job_id = get_shared_state().get(_conv_key(conv_id))
+
+        if job_id is None or not self._change_status(
+            job_id, "superseded", only_from="queued"
+        ):
+            return
+
+        with self._lock:
+            job = self._queued.get(job_id)
+
+            # if it's in this worker, free the documents
+            if job is not None:
+                self._release(job)
+
+    def join(self, conv_id):
+        """
+        called by an answer, that does the work itself: a job for conv_id
+        still in the queue (in any worker) is superseded, a running one
+        is waited for, so that the answer finds its result (index or
+        embeddings in the shared cache) and doesn't do the work again
+        """
+        self.supersede(conv_id)
+
+        job = self.get_job(conv_id=conv_id)
+
+        if job is not None and job["status"] == "running":
+            # held by the job while it runs
+            with get_shared_state().lock(_conv_key(conv_id)):
+                pass
+
+    def get_job(self, job_id=None, conv_id=None):
+        """
+        return the status of the job (by id, or the last for conv_id),
+        None if unknown
+        """
+        state = get_shared_state()
+
+        if job_id is None:
+            job_id = state.get(_conv_key(conv_id))
+
+            if job_id is None:
+                return None
+
+        return state.get(_job_key(job_id))
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+
+            with self._lock:
+                self._queued.pop(job.job_id, None)
+                documents = job.documents
+                self._release(job)
+
+            if documents is None:
+                # superseded
+                continue
+
+            # taken before the job is marked running: see join()
+            with get_shared_state().lock(_conv_key(job.conv_id)):
+                self._run(job, documents)
+
+    def _run(self, job, documents):
+        """
+        run a job, if still queued
+        """
+        from utils_profiling import profiler
+
+        job.time_start = time.time()
+
+        if not self._change_status(
+            job.job_id, "running", only_from="queued", time_start=job.time_start
+        ):
+            # superseded
+            return
+
+        job.status = "running"
+
+        try:
+            with profiler.request("prepare", conv_id=job.conv_id):
+                job.n_chunks = prepare_documents(job.conv_id, documents)
+
+            job.status = "done"
+            logger.info(
+                "Prepared conv_id %s: %s chunks in %s sec.",
+                job.conv_id,
+                job.n_chunks,
+                round(time.time() - job.time_start, 1),
+            )
+        except Exception as e:
+            logger.error("Error preparing documents for %s: %s", job.conv_id, e)
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.time_end = time.time()
+            self._save(job)
+
+
+prepare_queue = PrepareQueue(app_config["prepare"])
@@ -0,0 +1,299 @@
+"""
+Opt-in profiling: request traces and on-demand profiles
+
+    - traces: for every request (or a sample) the duration of the
+      spans (split, embed, index, search, llm, history), kept in a
+      ring buffer (the last max_traces requests)
+    - cProfile: armed for the next n requests, one request profiled
+      at a time (cProfile works on the thread of the request)
+    - sampling: for a few seconds the stacks of all the threads are
+      sampled, the result is in collapsed format (flame graphs)
+
+when disabled, span() returns a shared no-op context manager: the cost
+is a context variable lookup. Results are read from the admin endpoints
+(protected by the token in the ADMIN_TOKEN_ENV environment variable,
+not in config.toml: the config is returned by /get_config/).
+Settings are in [profiling] in config.toml
+"""
+
+import cProfile
+import hmac
+import io
+import itertools
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+# the token of the admin endpoints
+ADMIN_TOKEN_ENV = "HOL_API_ADMIN_TOKEN"
+
+# returned by span() when there is no trace
+_NO_SPAN = nullcontext()
+
+# the trace of the current request
+_current_trace = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """
+    the spans of a request
+    """
+
+    def __init__(self, trace_id, endpoint, attributes):
+        self.trace_id = trace_id
+        self.endpoint = endpoint
+        self.attributes = attributes
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        """
+        record the duration of a span
+        """
+        span_start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.spans.append((name, span_start, time.perf_counter()))
+
+    def to_dict(self):
+        """
+        times in msec., span start relative to the request start
+        """
+        return {
+            "trace_id": self.trace_id,
+            "endpoint": self.endpoint,
+            "attributes": self.attributes,
+            "timestamp": self.timestamp,
+            "duration_ms": _msec(self.duration),
+            "error": self.error,
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": _msec(span_start - self.start),
+                    "duration_ms": _msec(span_end - span_start),
+                }
+                for name, span_start, span_end in self.spans
+            ],
+        }
+
+
+def _msec(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class Profiler:
+    """
+    ring buffer of traces and on-demand profiles
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.traces = deque(maxlen=config["max_traces"])
+        self.captures = deque(maxlen=config["max_captures"])
+        self._ids = itertools.count(1)
+
+        # n. of requests still to profile with cProfile
+        self.cprofile_pending = 0
+        self._cprofile_lock = threading.Lock()
+        self._sampling_lock = threading.Lock()
+
+    def _new_trace(self, endpoint, attributes):
+        """
+        a new Trace, or None if the request is not sampled
+        """
+        if not self.config["enabled"]:
+            return None
+
+        if random.random() >= self.config["sample_rate"]:
+            return None
+
+        return Trace(next(self._ids), endpoint, attributes)
+
+    @contextmanager
+    def request(self, endpoint, **attributes):
+        """
+        trace (and maybe profile) the request executed in the block
+        """
+        trace = self._new_trace(endpoint, attributes)
+        token = _current_trace.set(trace) if trace is not None else None
+
+        profile = self._start_cprofile() if self.cprofile_pending > 0 else None
+
+        try:
+            yield
+        except Exception as e:
+            if trace is not None:
+                trace.error = repr(e)
+            raise
+        finally:
+            if profile is not None:
+                self._stop_cprofile(profile, endpoint)
+
+            if trace is not None:
+                trace.duration = time.perf_counter() - trace.start
+                _current_trace.reset(token)
+                self.traces.append(trace)
+
+    def get_traces(self, limit):
+        """
+        the last traces (at most limit), most recent first
+        """
+        if limit <= 0:
+            # [-0:] would be all the traces
+            return []
+
+        traces = list(self.traces)[-limit:]
+
+        return [trace.to_dict() for trace in reversed(traces)]
+
+    #
+    # cProfile
+    #
+    def arm_cprofile(self, n_requests):
+        """
+        profile the next n_requests requests
+        """
+        self.cprofile_pending = n_requests
+
+        logger.info("Profiling: cProfile armed for %s requests", n_requests)
+
+    def _start_cprofile(self):
+        """
+        return the Profile enabled, or None: only one request at a time
+        """
+        if not self._cprofile_lock.acquire(blocking=False):
+            return None
+
+        if self.cprofile_pending <= 0:
+            self._cprofile_lock.release()
+            return None
+
+        self.cprofile_pending -= 1
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+        return profile
+
+    def _stop_cprofile(self, profile, endpoint):
+        profile.disable()
+        self._cprofile_lock.release()
+
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(
+            self.config["max_functions"]
+        )
+
+        self.captures.append(
+            {
+                "capture_id": next(self._ids),
+                "mode": "cprofile",
+                "timestamp": time.time(),
+                "endpoint": endpoint,
+                "result": output.getvalue(),
+            }
+        )
+
+    #
+    # sampling
+    #
+    def sample(self, seconds, interval):
+        """
+        sample the stacks of all the threads for seconds
+        return the capture (stacks in collapsed format, with counts)
+        """
+        if not self._sampling_lock.acquire(blocking=False):
+            raise RuntimeError("A sampling capture is already running")
+
+        try:
+            stacks = Counter()
+            n_samples = 0
+            this_thread = threading.get_ident()
+            time_end = time.perf_counter() + seconds
+
+            while time.perf_counter() < time_end:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != this_thread:
+                        stacks[_collapse(frame)] += 1
+
+                n_samples += 1
+                time.sleep(interval)
+        finally:
+            self._sampling_lock.release()
+
+        capture = {
+            "capture_id": next(self._ids),
+            "mode": "sampling",
+            "timestamp": time.time(),
+            "seconds": seconds,
+            "n_samples": n_samples,
+            "stacks": [
+                {"stack": stack, "count": count}
+                for stack, count in stacks.most_common(self.config["max_functions"])
+            ],
+        }
+        self.captures.append(capture)
+
+        return capture
+
+
+def _collapse(frame):
+    """
+    the stack of a frame as "outer;...;inner" (file:function)
+    """
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+profiler = Profiler(app_config["profiling"])
+
+
+def span(name):
+    """
+    context manager: record a span in the trace of the current request
+    no-op if the request is not traced
+    """
+    trace = _current_trace.get()
+
+    if trace is None:
+        return _NO_SPAN
+
+    return trace.span(name)
+
+
+def check_admin_token(token):
+    """
+    True if token is the admin token (the admin endpoints are
+    disabled if the admin token is not set)
+    """
+    admin_token = os.environ.get(ADMIN_TOKEN_ENV, "")
+
+    if not admin_token or token is None:
+        return False
+
+    return hmac.compare_digest(token.encode("utf-8"), admin_token.encode("utf-8"))
@@ -0,0 +1,317 @@
+"""
+Rewriting of follow-up questions, for retrieval
+
+a follow-up like "Where does he live?" embedded as it is retrieves poor
+chunks. The query is rewritten using the conversation history:
+    - heuristic (local, a few microsec.): if the query refers to
+      someone mentioned before (personal pronouns, or a short query
+      starting with "and", "what about"...), the names found in the
+      last messages are added to the query
+    - llm: a small, fast model rewrites the query as a standalone one
+      (through the resilience layer, counted in the stats of the model)
+
+the rewrite and the embeddings of both queries run in background, while
+the index of the conversation is updated. If the rewritten query is not
+ready within the latency budget only the raw query is used.
+The raw query is embedded in its own pool: rewrites out of the budget
+(a slow model, retries) can't delay it. The rewrites in flight are
+bounded (max_rewrites_inflight), over it the query is not rewritten.
+Retrieval is done with both queries and the results are fused
+(see utils_rerank.retrieve).
+Settings are in the [query_rewrite] section of config.toml
+"""
+
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+# personal pronouns: they refer to someone said before. "it", "this",
+# "that", "there"... are not used, they're in most of the questions
+FOLLOW_UP_REGEX = re.compile(
+    r"\b(he|she|him|his|her|hers|they|them|their|theirs|himself|herself)\b",
+    re.IGNORECASE,
+)
+# short queries continuing the previous one ("and Anna?", "what about Mark?")
+FOLLOW_UP_START_REGEX = re.compile(
+    r"^\W*(and|also|what about|how about|same for|why)\b", re.IGNORECASE
+)
+# sequences of capitalized words (names)
+NAME_REGEX = re.compile(r"\b[A-Z][\w'.-]*(?:\s+[A-Z][\w'.-]*)*")
+SENTENCE_START_REGEX = re.compile(r"(?:^|[.!?:\n]\s*)$")
+
+# max words of a short follow-up ("and Anna?")
+SHORT_QUERY_WORDS = 4
+
+REWRITE_PROMPT = """Rewrite the last question of the conversation as a standalone question, \
+replacing pronouns and references with what they refer to.
+Return only the rewritten question.
+
+Conversation:
+{history}
+
+Last question: {query}
+Standalone question:"""
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# rewrites submitted and not completed (also the ones out of the budget)
+_rewrite_slots = threading.BoundedSemaphore(
+    app_config["query_rewrite"]["max_rewrites_inflight"]
+)
+
+
+def _get_pool(name):
+    """
+    return a thread pool:
+    "embed" for the raw queries, "rewrite" for the rewrites (and the
+    embeddings of the rewritten queries)
+    """
+    config = app_config["query_rewrite"]
+
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(
+                max_workers=(
+                    config["pool_size"]
+                    if name == "embed"
+                    else config["max_rewrites_inflight"]
+                ),
+                thread_name_prefix=f"query_{name}",
+            )
+
+    return _pools[name]
+
+
+def _message_text(msg):
+    """
+    (role, text) of a message of the chat history
+    """
+    role = "USER" if msg.type == "human" else "CHATBOT"
+
+    return role, msg.content
+
+
+def is_follow_up(query):
+    """
+    True if the query probably refers to the previous messages
+    """
+    return bool(FOLLOW_UP_REGEX.search(query)) or (
+        len(query.split()) <= SHORT_QUERY_WORDS
+        and bool(FOLLOW_UP_START_REGEX.search(query))
+    )
+
+
+def extract_names(text):
+    """
+    return the names (sequences of capitalized words) in text
+    a single capitalized word at the start of a sentence is not a name
+    """
+    names = []
+
+    for match in NAME_REGEX.finditer(text):
+        name = match.group(0).rstrip(".'-")
+        if name.endswith("'s"):
+            name = name[:-2]
+
+        at_sentence_start = SENTENCE_START_REGEX.search(text[: match.start()])
+        if at_sentence_start and " " not in name:
+            continue
+
+        if name and name not in names:
+            names.append(name)
+
+    return names
+
+
+def heuristic_rewrite(query, chat_history):
+    """
+    add to a follow-up query the names of the last messages
+    return the rewritten query, or None if not needed
+    """
+    if not chat_history or not is_follow_up(query):
+        return None
+
+    max_names = app_config["query_rewrite"]["max_names"]
+
+    # the most recent messages first, user messages before the answers
+    messages = [_message_text(msg) for msg in reversed(chat_history)]
+    messages.sort(key=lambda message: message[0] != "USER")
+
+    names = []
+    for _, text in messages:
+        for name in extract_names(text):
+            if name not in names and name not in query:
+                names.append(name)
+        if names:
+            break
+
+    if not names:
+        # no names: add the last question
+        last_questions = [text for role, text in messages if role == "USER"]
+
+        return f"{query} {last_questions[0]}" if last_questions else None
+
+    return f"{query} {' '.join(names[:max_names])}"
+
+
+def llm_rewrite(query, chat_history):
+    """
+    rewrite the query with the small model
+    """
+    from utils_routing import call_model, estimate_tokens
+
+    config = app_config["query_rewrite"]
+
+    history = "\n".join(
+        f"{role}: {text}"
+        for role, text in map(_message_text, chat_history[-config["history_msgs"] :])
+    )
+    prompt = REWRITE_PROMPT.format(history=history, query=query)
+
+    # retries, circuit breaker and stats of the model, as the answers.
+    # The latency (short prompt) is not used for the routing
+    response = call_model(
+        config["model_id"], estimate_tokens(prompt), prompt, track_latency=False
+    )
+    rewritten = response.content.strip()
+
+    return rewritten or None
+
+
+class RewriteStats:
+    """
+    n. of queries rewritten, of rewrites out of the latency budget
+    and of rewrites skipped (too many in flight)
+    """
+
+    def __init__(self):
+        self.n_queries = 0
+        self.n_rewritten = 0
+        self.n_timeouts = 0
+        self.n_skipped = 0
+        self._lock = threading.Lock()
+
+    def record(self, rewritten, timeout, skipped=False):
+        with self._lock:
+            self.n_queries += 1
+            self.n_rewritten += int(rewritten)
+            self.n_timeouts += int(timeout)
+            self.n_skipped += int(skipped)
+
+    def to_dict(self):
+        """
+        for the stats endpoint
+        """
+        with self._lock:
+            return {
+                "n_queries": self.n_queries,
+                "n_rewritten": self.n_rewritten,
+                "n_timeouts": self.n_timeouts,
+                "n_skipped": self.n_skipped,
+            }
+
+
+rewrite_stats = RewriteStats()
+
+
+class SpeculativeQuery:
+    """
+    the vectors of the raw and of the rewritten query
+
+    computed in background (while the index of the conversation is
+    updated): the raw query is embedded, at the same time the query is
+    rewritten and embedded. If the rewrite is not ready at the end of the
+    latency budget only the raw query is used
+    """
+
+    def __init__(self, embed_model, query, chat_history):
+        config = app_config["query_rewrite"]
+
+        self.embed_model = embed_model
+        self.query = query
+        self.chat_history = list(chat_history)
+        self.deadline = time.perf_counter() + config["latency_budget_ms"] / 1000
+
+        self._raw = _get_pool("embed").submit(embed_model.embed_query, query)
+        self._rewritten = None
+        self._skipped = False
+
+        if config["enabled"] and self.chat_history and is_follow_up(query):
+            self._submit_rewrite(config["mode"])
+
+    def _submit_rewrite(self, mode):
+        """
+        start the rewrite, if there is a free slot
+        (not queued: it would be out of the budget anyway)
+        """
+        if not _rewrite_slots.acquire(blocking=False):
+            self._skipped = True
+            logger.info("Query rewrite: too many in flight, not rewritten")
+            return
+
+        try:
+            self._rewritten = _get_pool("rewrite").submit(self._rewrite_and_embed, mode)
+        except Exception:
+            _rewrite_slots.release()
+            raise
+
+        self._rewritten.add_done_callback(lambda _: _rewrite_slots.release())
+
+    def _rewrite_and_embed(self, mode):
+        """
+        return (rewritten query, vector) or None
+        """
+        if mode == "llm":
+            rewritten = llm_rewrite(self.query, self.chat_history)
+        else:
+            rewritten = heuristic_rewrite(self.query, self.chat_history)
+
+        if rewritten is None or rewritten == self.query:
+            return None
+
+        return rewritten, self.embed_model.embed_query(rewritten)
+
+    def query_vectors(self):
+        """
+        return the list of query vectors: raw and, if ready, rewritten
+        """
+        vectors = [self._raw.result()]
+
+        if self._skipped:
+            rewrite_stats.record(False, False, skipped=True)
+
+        if self._rewritten is None:
+            return vectors
+
+        result = None
+        timeout = False
+        try:
+            result = self._rewritten.result(
+                timeout=max(self.deadline - time.perf_counter(), 0)
+            )
+        except FutureTimeoutError:
+            # it goes on in background, the result is ignored
+            timeout = True
+            logger.info("Query rewrite: out of the latency budget, not used")
+        except Exception as e:
+            logger.warning("Query rewrite: error: %s", e)
+
+        rewrite_stats.record(result is not None, timeout)
+
+        if result is not None:
+            rewritten, vector = result
+            vectors.append(vector)
+
+            if app_config["general"]["verbose"]:
+                logger.info("Query rewritten as: %s", rewritten)
+
+        return vectors
@@ -0,0 +1,195 @@
+"""
+Lightweight post-retrieval stage (no cross-encoder, no service call)
+
+    - adaptive k: the number of chunks is cut at the largest gap in the
+      distances of the candidates, between k_min and k_max
+    - maximal marginal relevance (MMR) to avoid near duplicate chunks
+    - fusion of the results of more queries (raw and rewritten query):
+      the distance of a chunk is the distance from the closest query
+
+everything runs vectorized with numpy on the vectors already
+in the index. Settings are in the [rerank] section of config.toml
+"""
+
+import threading
+
+import numpy as np
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+
+def adaptive_k(distances, k_min, k_max, gap_ratio):
+    """
+    choose how many chunks to keep
+    distances: of the candidates, sorted (ascending)
+
+    the cut is done at the largest gap between consecutive distances
+    (with at least k_min chunks), if that gap is at least gap_ratio
+    times the mean gap. Otherwise we keep k_max chunks
+    """
+    distances = np.asarray(distances[:k_max], dtype=np.float32)
+    n_chunks = len(distances)
+
+    if n_chunks <= k_min:
+        return n_chunks
+
+    gaps = np.diff(distances)
+    # gaps[i] is between chunk i and i + 1: cutting there keeps i + 1 chunks
+    window = gaps[k_min - 1 :]
+    best = int(np.argmax(window))
+
+    if window[best] >= gap_ratio * gaps.mean() and window[best] > 0:
+        return k_min + best
+
+    return n_chunks
+
+
+def mmr(query_vector, vectors, k, lambda_mult):
+    """
+    maximal marginal relevance
+    return the positions (in vectors) of the k chunks selected, in order
+
+    query_vector: a vector, or a matrix with a query per row
+    (the relevance is the similarity with the closest query)
+    lambda_mult: 1 = only relevance, 0 = only diversity
+    """
+    if k <= 0 or len(vectors) == 0:
+        return []
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.atleast_2d(np.asarray(query_vector, dtype=np.float32))
+
+    # cosine similarity
+    vectors = vectors / np.maximum(
+        np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12
+    )
+    queries = queries / np.maximum(
+        np.linalg.norm(queries, axis=1, keepdims=True), 1e-12
+    )
+
+    relevance = (vectors @ queries.T).max(axis=1)
+    # max similarity with the chunks already selected
+    redundancy = np.full(len(vectors), -np.inf, dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+
+    selected = []
+    for _ in range(min(k, len(vectors))):
+        if selected:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        else:
+            scores = relevance.copy()
+
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, vectors @ vectors[best])
+
+    return selected
+
+
+class RetrievalStats:
+    """
+    average number of chunks per prompt, with and without the rerank stage
+    """
+
+    def __init__(self):
+        self.n_requests = 0
+        self.chunks_before = 0
+        self.chunks_after = 0
+        self._lock = threading.Lock()
+
+    def record(self, before, after):
+        """
+        before: chunks we would have used with the fixed k
+        after: chunks selected
+        """
+        with self._lock:
+            self.n_requests += 1
+            self.chunks_before += before
+            self.chunks_after += after
+
+    def to_dict(self):
+        """
+        for the stats endpoint
+        """
+        with self._lock:
+            n_requests = max(self.n_requests, 1)
+
+            return {
+                "n_requests": self.n_requests,
+                "avg_chunks_fixed_k": round(self.chunks_before / n_requests, 2),
+                "avg_chunks_reranked": round(self.chunks_after / n_requests, 2),
+            }
+
+
+retrieval_stats = RetrievalStats()
+
+
+def search_fused(index, query_vectors, k):
+    """
+    search with one or more queries, return ids and distances of the
+    k nearest chunks. The distance of a chunk is from the closest query
+    """
+    if len(query_vectors) == 1:
+        return index.search_ids(query_vectors[0], k=k)
+
+    best = {}
+    for query_vector in query_vectors:
+        ids, distances = index.search_ids(query_vector, k=k)
+
+        for chunk_id, distance in zip(ids.tolist(), distances.tolist()):
+            best[chunk_id] = min(distance, best.get(chunk_id, np.inf))
+
+    ranked = sorted(best.items(), key=lambda item: item[1])[:k]
+
+    return (
+        np.array([chunk_id for chunk_id, _ in ranked], dtype=np.int64),
+        np.array([distance for _, distance in ranked], dtype=np.float32),
+    )
+
+
+def retrieve(index, query_vectors):
+    """
+    semantic search in index (a ChunkIndex) + rerank stage
+    query_vectors: a query vector, or a list of vectors
+    (raw and rewritten query), results are fused
+    return a list of (doc, distance)
+    """
+    k = app_config["retriever"]["k"]
+    config = app_config["rerank"]
+
+    query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+
+    if not config["enabled"]:
+        ids, distances = search_fused(index, query_vectors, k)
+
+        return [(index.items[i], float(d)) for i, d in zip(ids, distances)]
+
+    ids, distances = search_fused(
+        index, query_vectors, config["k_max"] * config["fetch_factor"]
+    )
+
+    if len(ids) == 0:
+        return []
+
+    n_chunks = adaptive_k(
+        distances, config["k_min"], config["k_max"], config["gap_ratio"]
+    )
+
+    # the vectors are already in the index, no call to the embeddings model
+    selected = mmr(
+        query_vectors, index.get_vectors(ids), n_chunks, config["lambda_mult"]
+    )
+
+    retrieval_stats.record(min(k, len(ids)), len(selected))
+
+    if app_config["general"]["verbose"]:
+        logger.info("Rerank: %s chunks selected (fixed k: %s)", len(selected), k)
+
+    return [(index.items[ids[i]], float(distances[i])) for i in selected]
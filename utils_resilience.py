@@ -0,0 +1,373 @@
+"""
+Resilience layer for the calls to OCI GenAI (chat and embeddings)
+
+    - retries with jittered exponential backoff on retryable errors
+      (throttling, 5xx, network errors)
+    - optional hedged requests: if a call is slower than the p95
+      of the latencies observed, a second identical call is fired
+      and the first one that completes wins. Latencies are kept per
+      type of call (ex: a query vs a batch of 90 texts)
+    - a circuit breaker that fails fast when the service is unhealthy
+
+settings are in the [resilience] section of config.toml
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+# HTTP status codes for which it makes sense to retry
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# circuit breaker states
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """
+    raised when the circuit breaker is open: the call is not attempted
+    """
+
+
+def is_retryable(e):
+    """
+    return True if the exception signals a transient problem
+
+    OCI ServiceError has a status (HTTP code), network errors
+    from requests are subclasses of OSError
+    """
+    if isinstance(e, CircuitOpenError):
+        return False
+
+    status = getattr(e, "status", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+
+    return isinstance(e, (ConnectionError, TimeoutError, OSError))
+
+
+class CircuitBreaker:
+    """
+    a simple, thread safe, circuit breaker
+
+    after failure_threshold consecutive failures the circuit opens and
+    all calls fail fast for reset_timeout sec.
+    Then a single probe call is allowed (half open): if it succeeds
+    the circuit closes, otherwise it opens again
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        check if the call is allowed, raise CircuitOpenError if not
+        """
+        with self._lock:
+            if self.state == STATE_OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"Circuit {self.name} is open")
+
+                # time to try again with a single probe
+                self.state = STATE_HALF_OPEN
+                self._probe_in_flight = False
+
+            if self.state == STATE_HALF_OPEN:
+                if self._probe_in_flight:
+                    raise CircuitOpenError(f"Circuit {self.name} is half open")
+                self._probe_in_flight = True
+
+    def record_success(self):
+        """
+        the service has answered
+        """
+        with self._lock:
+            if self.state != STATE_CLOSED:
+                logger.info("Circuit %s closed", self.name)
+
+            self.state = STATE_CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        """
+        the call has failed with a retryable error
+        """
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+
+            if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != STATE_OPEN:
+                    logger.warning("Circuit %s opened", self.name)
+
+                self.state = STATE_OPEN
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """
+    keep the latencies of the last calls (rolling window)
+    """
+
+    def __init__(self, window):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        """
+        add a sample (in sec.)
+        """
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, perc, min_samples=1):
+        """
+        return the percentile (0 < perc < 1) of the samples
+        None if we don't have at least min_samples
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+
+        if len(samples) < max(min_samples, 1):
+            return None
+
+        idx = min(int(perc * len(samples)), len(samples) - 1)
+
+        return samples[idx]
+
+
+class ResilientCaller:
+    """
+    wraps calls to a remote service with retries,
+    hedging and a circuit breaker
+    """
+
+    def __init__(self, name, config, hedging=False):
+        self.name = name
+        self.max_retries = config["max_retries"]
+        self.backoff_base = config["backoff_base"]
+        self.backoff_max = config["backoff_max"]
+
+        self.hedging = hedging
+        self.hedging_percentile = config["hedging_percentile"]
+        self.hedging_min_samples = config["hedging_min_samples"]
+
+        self.breaker = CircuitBreaker(
+            name,
+            failure_threshold=config["breaker_failure_threshold"],
+            reset_timeout=config["breaker_reset_timeout"],
+        )
+        self.latency_window = config["latency_window"]
+        # latency_key -> LatencyTracker
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def get_latency(self, latency_key=None):
+        """
+        return the LatencyTracker for a type of call (created at first use)
+        """
+        with self._lock:
+            if latency_key not in self.latencies:
+                self.latencies[latency_key] = LatencyTracker(self.latency_window)
+
+        return self.latencies[latency_key]
+
+    def call(self, func, *args, latency_key=None, **kwargs):
+        """
+        call func(*args, **kwargs) applying the resilience policies
+        latency_key: the type of call, calls with different latency
+        (ex: 1 text or 90 texts to embed) have separate hedging deadlines
+        """
+        latency = self.get_latency(latency_key)
+        attempt = 0
+
+        while True:
+            # fail fast if the circuit is open
+            self.breaker.before_call()
+
+            try:
+                result = self._call_once(latency, func, args, kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # the service has answered (ex: 400), it is healthy
+                    self.breaker.record_success()
+                    raise
+
+                self.breaker.record_failure()
+
+                if attempt >= self.max_retries:
+                    logger.error("%s: giving up after %s retries", self.name, attempt)
+                    raise
+
+                # exponential backoff with full jitter
+                delay = random.uniform(
+                    0, min(self.backoff_max, self.backoff_base * 2**attempt)
+                )
+                logger.warning(
+                    "%s: retryable error (%s), retry in %s sec...",
+                    self.name,
+                    e,
+                    round(delay, 2),
+                )
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self.breaker.record_success()
+
+            return result
+
+    @staticmethod
+    def _timed_call(latency, func, args, kwargs):
+        """
+        call and record the latency (only for successful calls)
+        """
+        time_start = time.monotonic()
+
+        result = func(*args, **kwargs)
+
+        latency.add(time.monotonic() - time_start)
+
+        return result
+
+    def _call_once(self, latency, func, args, kwargs):
+        """
+        a single attempt, hedged if enabled and we have enough samples
+        """
+        deadline = None
+        if self.hedging:
+            deadline = latency.percentile(
+                self.hedging_percentile, self.hedging_min_samples
+            )
+
+        if deadline is None:
+            return self._timed_call(latency, func, args, kwargs)
+
+        # the first call runs in its own thread, not in the hedging pool:
+        # it doesn't wait for a free thread and the number of calls in
+        # flight is not limited by the pool size
+        primary = Future()
+        threading.Thread(
+            target=_run_in_future,
+            args=(primary, self._timed_call, latency, func, args, kwargs),
+            name=f"{self.name}-call",
+            daemon=True,
+        ).start()
+
+        done, _ = wait([primary], timeout=deadline)
+        if done:
+            return primary.result()
+
+        hedge = _submit_hedge(self._timed_call, latency, func, args, kwargs)
+        if hedge is None:
+            # all the hedging threads are busy, a hedge would wait in queue
+            return primary.result()
+
+        logger.info(
+            "%s: no answer after %s sec., hedged request sent",
+            self.name,
+            round(deadline, 2),
+        )
+
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+        # both have failed
+        raise primary.exception()
+
+
+def _run_in_future(future, func, *args):
+    """
+    run func and set its result (or exception) in future
+    """
+    try:
+        future.set_result(func(*args))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+#
+# module level objects, shared by all the requests
+#
+_callers = {}
+_callers_lock = threading.Lock()
+_hedging_pool = None
+# free threads in the hedging pool
+_hedging_slots = None
+
+
+def _submit_hedge(func, *args):
+    """
+    run func in the hedging pool, return the future
+    None if all the threads of the pool are busy
+    """
+    global _hedging_pool, _hedging_slots
+
+    with _callers_lock:
+        if _hedging_pool is None:
+            pool_size = app_config["resilience"]["hedging_pool_size"]
+
+            _hedging_pool = ThreadPoolExecutor(
+                max_workers=pool_size, thread_name_prefix="hedging"
+            )
+            _hedging_slots = threading.BoundedSemaphore(pool_size)
+
+    if not _hedging_slots.acquire(blocking=False):
+        return None
+
+    future = _hedging_pool.submit(func, *args)
+    future.add_done_callback(lambda _: _hedging_slots.release())
+
+    return future
+
+
+def get_resilient_caller(name):
+    """
+    return the caller for a service (chat, embeddings), or for an
+    instance of a service (ex: chat/<model_id>), each with its breaker
+    """
+    with _callers_lock:
+        if name not in _callers:
+            config = app_config["resilience"]
+            service = name.split("/", 1)[0]
+
+            _callers[name] = ResilientCaller(
+                name, config, hedging=config.get(f"hedging_{service}", False)
+            )
+
+    return _callers[name]
+
+
+def call_with_resilience(name, func, *args, latency_key=None, **kwargs):
+    """
+    call func applying retries, hedging and circuit breaking
+    name: the service (chat, embeddings) or service/instance
+    latency_key: the type of call, for the hedging deadline
+    """
+    return get_resilient_caller(name).call(
+        func, *args, latency_key=latency_key, **kwargs
+    )
@@ -0,0 +1,273 @@
+"""
+Routing of the requests to the chat models
+
+    - short-context requests and summarize go to the small model
+      (cohere.command-r-16k, cheaper and faster), the others to the
+      large model (cohere.command-r-plus)
+    - the size of the prompt is estimated in tokens (from the chars)
+    - the latency of every model is compared with its own baseline
+      (the models have different speeds and get prompts of different
+      sizes, their latencies can't be compared): if the small model is
+      much slower than usual we use the large one, if the large one is
+      overloaded we use the small one (when the prompt fits in its
+      context). A few requests (explore_rate) still go to the model
+      avoided, to measure it again
+    - every model has its own resilient caller: the failures of a
+      model don't open the circuit breaker of the other
+
+with change_config a model can be pinned (routing disabled), with
+"auto" routing is enabled again. Settings are in [routing] in config.toml
+"""
+
+import random
+import threading
+import time
+
+from utils import get_app_config, get_console_logger
+from utils_models import get_chat_model
+from utils_resilience import LatencyTracker, call_with_resilience
+from utils_shared_state import set_config_overrides
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+# for change_config: enable the routing
+AUTO_MODEL = "auto"
+
+
+def estimate_tokens(*texts):
+    """
+    estimate the n. of tokens of texts (no tokenizer, from the chars)
+    """
+    n_chars = sum(len(text) for text in texts)
+
+    return int(n_chars / app_config["routing"]["chars_per_token"])
+
+
+class ModelStats:
+    """
+    latency and token counters of a model
+    latency: the last calls, baseline: a longer window (the usual latency)
+    """
+
+    def __init__(self, window, baseline_window):
+        self.latency = LatencyTracker(window)
+        self.baseline = LatencyTracker(baseline_window)
+        self.n_calls = 0
+        self.n_errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, prompt_tokens, completion_tokens, error=False):
+        """
+        record a call (latency in sec., tokens estimated)
+        latency None: not used for routing (ex: query rewrite, short prompts)
+        """
+        if not error and latency is not None:
+            self.latency.add(latency)
+            self.baseline.add(latency)
+
+        with self._lock:
+            self.n_calls += 1
+            self.n_errors += int(error)
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def to_dict(self):
+        """
+        for the stats endpoint
+        """
+        p50 = self.latency.percentile(0.5)
+        p95 = self.latency.percentile(0.95)
+
+        baseline_p50 = self.baseline.percentile(0.5)
+
+        with self._lock:
+            return {
+                "n_calls": self.n_calls,
+                "n_errors": self.n_errors,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "latency_p50": None if p50 is None else round(p50, 3),
+                "latency_p95": None if p95 is None else round(p95, 3),
+                "baseline_p50": (
+                    None if baseline_p50 is None else round(baseline_p50, 3)
+                ),
+            }
+
+    def slowdown(self, min_samples):
+        """
+        median latency of the last calls / usual median latency
+        None if we don't have enough samples
+        """
+        p50 = self.latency.percentile(0.5, min_samples)
+        baseline_p50 = self.baseline.percentile(0.5, min_samples)
+
+        if p50 is None or not baseline_p50:
+            return None
+
+        return p50 / baseline_p50
+
+
+class ModelRouter:
+    """
+    choose the model for a request and keep the stats of the models
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def get_stats(self, model_id):
+        """
+        return the ModelStats of a model (created at first use)
+        """
+        with self._lock:
+            if model_id not in self.stats:
+                self.stats[model_id] = ModelStats(
+                    self.config["latency_window"], self.config["baseline_window"]
+                )
+
+        return self.stats[model_id]
+
+    def _is_slow(self, model_id):
+        """
+        True if the model is much slower than usual
+        """
+        slowdown = self.get_stats(model_id).slowdown(self.config["min_samples"])
+
+        return slowdown is not None and slowdown > self.config["slow_ratio"]
+
+    def choose_model(self, task, prompt_tokens):
+        """
+        return the model_id for a request
+        task: answer or summarize
+        prompt_tokens: estimated size of the prompt
+        """
+        config = self.config
+
+        if not config["enabled"]:
+            # pinned with change_config (or routing disabled)
+            return app_config["oci"]["model_id"]
+
+        small, large = config["small_model"], config["large_model"]
+
+        # the prompt and the answer must fit in the context of the small model
+        fits_small = (
+            prompt_tokens + app_config["llm"]["max_tokens"]
+            <= config["small_context_tokens"]
+        )
+        if not fits_small:
+            return large
+
+        # a few requests go to the preferred model anyway,
+        # so that its latency is measured again
+        if random.random() < config["explore_rate"]:
+            small_slow = large_slow = False
+        else:
+            small_slow, large_slow = self._is_slow(small), self._is_slow(large)
+
+        if task == "summarize" or prompt_tokens <= config["short_context_tokens"]:
+            # the small model is degraded (and the large one is not)
+            if small_slow and not large_slow:
+                return large
+
+            return small
+
+        # the large model is overloaded
+        if large_slow and not small_slow:
+            return small
+
+        return large
+
+    def to_dict(self):
+        """
+        for the stats endpoint
+        """
+        with self._lock:
+            stats = dict(self.stats)
+
+        return {model_id: model.to_dict() for model_id, model in stats.items()}
+
+
+router = ModelRouter(app_config["routing"])
+
+
+def call_model(model_id, prompt_tokens, *args, track_latency=True, **kwargs):
+    """
+    invoke a chat model (with retries, hedging, circuit breaker),
+    the call is recorded in the stats of the model
+    track_latency: False if the latency is not comparable with
+    the answers (it is used by the routing)
+    """
+    stats = router.get_stats(model_id)
+    chat = get_chat_model(model_id)
+
+    time_start = time.perf_counter()
+    try:
+        # a caller (and a circuit breaker) for every model
+        response = call_with_resilience(
+            f"chat/{model_id}", chat.invoke, *args, **kwargs
+        )
+    except Exception:
+        stats.record(time.perf_counter() - time_start, prompt_tokens, 0, error=True)
+        raise
+
+    latency = time.perf_counter() - time_start
+    stats.record(
+        latency if track_latency else None,
+        prompt_tokens,
+        estimate_tokens(response.content),
+    )
+
+    return response
+
+
+def invoke_chat(task, query, documents, chat_history):
+    """
+    invoke the chat model chosen by the router
+    (with retries, hedging, circuit breaker)
+    """
+    prompt_tokens = estimate_tokens(
+        query,
+        *(doc["snippet"] for doc in documents),
+        *(msg.content for msg in chat_history),
+    )
+    model_id = router.choose_model(task, prompt_tokens)
+
+    if app_config["general"]["verbose"]:
+        logger.info("Routing: %s, ~%s tokens -> %s", task, prompt_tokens, model_id)
+
+    return call_model(
+        model_id,
+        prompt_tokens,
+        query,
+        chat_history=chat_history,
+        documents=documents,
+    )
+
+
+def set_model(id_model):
+    """
+    pin a model (routing disabled) or, with "auto", enable routing
+    the change is applied by all the workers
+    """
+    if id_model == AUTO_MODEL:
+        set_config_overrides({"routing.enabled": True})
+        return
+
+    if id_model not in app_config["routing"]["models"]:
+        raise ValueError(f"Model not supported: {id_model}")
+
+    set_config_overrides({"routing.enabled": False, "oci.model_id": id_model})
+
+
+def warm_clients():
+    """
+    create the clients of all the models (cached in utils_models)
+    """
+    for model_id in app_config["routing"]["models"]:
+        get_chat_model(model_id)
@@ -0,0 +1,349 @@
+"""
+Serialization and compression for the HTTP layer
+
+    - structured (JSON) output for answers with citations, citations
+      mapped to the offsets in the original documents
+    - request bodies parsed with orjson
+    - compressed request bodies (Content-Encoding: gzip, deflate, br)
+    - size limits on the bodies, checked while the body is read
+
+responses are encoded with orjson (ORJSONResponse) and compressed
+with gzip by the middleware configured in main
+"""
+
+import zlib
+
+import orjson
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it only gzip and deflate are accepted
+    brotli = None
+
+
+def _field(obj, name):
+    """
+    read a field from an OCI model object or from a dict
+    (in streaming mode citations are plain dicts)
+    """
+    if isinstance(obj, dict):
+        return obj.get(name)
+
+    return getattr(obj, name, None)
+
+
+def citations_to_dict(citations):
+    """
+    convert Cohere citations in a list of dict
+    """
+    return [
+        {
+            "start": _field(citation, "start"),
+            "end": _field(citation, "end"),
+            "text": _field(citation, "text"),
+            "document_ids": list(_field(citation, "document_ids") or []),
+        }
+        for citation in citations or []
+    ]
+
+
+def chunk_to_dict(doc):
+    """
+    a chunk (LangChain Document) with its position in the original documents
+    """
+    metadata = doc.metadata
+
+    return {
+        "chunk_id": metadata.get("chunk_id"),
+        "doc_index": metadata.get("doc_index"),
+        "start": metadata.get("start_index"),
+        "end": metadata.get("end_index"),
+        "snippet": doc.page_content,
+    }
+
+
+def locate_citation(text, doc):
+    """
+    map a citation to the offsets in the original document
+
+    Cohere's citation text is a span of the generated answer, not of the
+    source: it is found in the chunk only when the model quoted it word
+    for word. Then the offsets are those of the quote (match = "verbatim"),
+    otherwise (the usual case) those of the whole chunk cited
+    (match = "chunk"), not to be used as precise highlights.
+    The search is done only in the chunk cited (a few KB)
+    """
+    metadata = doc.metadata
+    start = metadata.get("start_index")
+    pos = doc.page_content.find(text) if text and start is not None else -1
+
+    if pos < 0:
+        return {
+            "chunk_id": metadata.get("chunk_id"),
+            "doc_index": metadata.get("doc_index"),
+            "start": start,
+            "end": metadata.get("end_index"),
+            "match": "chunk",
+        }
+
+    return {
+        "chunk_id": metadata.get("chunk_id"),
+        "doc_index": metadata.get("doc_index"),
+        "start": start + pos,
+        "end": start + pos + len(text),
+        "match": "verbatim",
+    }
+
+
+def _chunks_by_document_id(chunks):
+    """
+    document id used by Cohere -> chunk
+    Cohere uses the id we give to the document, or doc_<position>
+    """
+    by_id = {}
+
+    for position, doc in enumerate(chunks):
+        by_id[f"doc_{position}"] = doc
+
+        if "chunk_id" in doc.metadata:
+            by_id[doc.metadata["chunk_id"]] = doc
+
+    return by_id
+
+
+def build_citations_output(response, chunks=None):
+    """
+    build the structured output for answer_with_citations
+
+    response: the AIMessage returned by ChatOCIGenAI,
+    Cohere citations and documents are in additional_kwargs
+    chunks: the chunks (LangChain Documents) sent to the model, in order.
+    If given, every citation has its sources: offsets in the original
+    documents (of the chunk, or of the quote if verbatim, see
+    locate_citation), and documents are the chunks cited, with their offsets
+    """
+    info = response.additional_kwargs
+    citations = citations_to_dict(info.get("citations"))
+
+    # return only the documents referenced by a citation
+    cited_ids = {
+        doc_id for citation in citations for doc_id in citation["document_ids"]
+    }
+
+    if chunks is None:
+        documents = [
+            doc for doc in info.get("documents") or [] if _field(doc, "id") in cited_ids
+        ]
+
+        return {
+            "text": response.content,
+            "citations": citations,
+            "documents": documents,
+        }
+
+    by_id = _chunks_by_document_id(chunks)
+
+    for citation in citations:
+        citation["sources"] = [
+            locate_citation(citation["text"], by_id[doc_id])
+            for doc_id in citation["document_ids"]
+            if doc_id in by_id
+        ]
+
+    cited = [
+        doc
+        for position, doc in enumerate(chunks)
+        if f"doc_{position}" in cited_ids or doc.metadata.get("chunk_id") in cited_ids
+    ]
+    # in the order of the original documents
+    cited.sort(
+        key=lambda doc: (
+            doc.metadata.get("doc_index", 0),
+            doc.metadata.get("start_index", 0),
+        )
+    )
+
+    return {
+        "text": response.content,
+        "citations": citations,
+        "documents": [chunk_to_dict(doc) for doc in cited],
+    }
+
+
+def _too_large(detail="Request body too large."):
+    return HTTPException(status_code=413, detail=detail)
+
+
+class BodyDecoder:
+    """
+    incremental decompression of a request body, chunk by chunk
+    the size of the output is checked at every chunk (zip bombs)
+    """
+
+    def __init__(self, encoding, max_size):
+        self.encoding = encoding.strip().lower()
+        self.max_size = max_size
+        self.size = 0
+
+        if self.encoding in ("", "identity"):
+            self._decompressor = None
+        elif self.encoding in ("gzip", "deflate"):
+            # wbits: 16 + MAX_WBITS for gzip, MAX_WBITS for zlib (deflate)
+            wbits = 16 + zlib.MAX_WBITS if self.encoding == "gzip" else zlib.MAX_WBITS
+            self._decompressor = zlib.decompressobj(wbits)
+        elif self.encoding == "br" and brotli is not None:
+            self._decompressor = brotli.Decompressor()
+        else:
+            raise HTTPException(
+                status_code=415, detail=f"Unsupported encoding: {encoding}"
+            )
+
+    def _check(self, data):
+        self.size += len(data)
+
+        if self.size > self.max_size:
+            raise _too_large()
+
+        return data
+
+    def decode(self, chunk):
+        """
+        return the decompressed data of a chunk
+        """
+        if self._decompressor is None:
+            return self._check(chunk)
+
+        try:
+            if self.encoding == "br":
+                return self._check(self._decompressor.process(chunk))
+
+            # at most one byte more than allowed: enough to detect the excess
+            data = self._decompressor.decompress(chunk, self.max_size - self.size + 1)
+        except (zlib.error, getattr(brotli, "error", zlib.error)) as e:
+            raise HTTPException(
+                status_code=400, detail="Invalid compressed body."
+            ) from e
+
+        if self._decompressor.unconsumed_tail:
+            raise _too_large()
+
+        return self._check(data)
+
+    def flush(self):
+        """
+        return the remaining data, at the end of the body
+        """
+        if self._decompressor is None or self.encoding == "br":
+            return b""
+
+        return self._check(self._decompressor.flush())
+
+
+def check_payload_limits(payload, max_documents, max_document_chars, max_query_chars):
+    """
+    check the size of documents and query in a parsed body
+    raise 413 before the validation (Pydantic errors contain the input)
+    """
+    if not isinstance(payload, dict):
+        return
+
+    documents = payload.get("documents")
+    if isinstance(documents, list):
+        if len(documents) > max_documents:
+            raise _too_large(f"Too many documents (max {max_documents}).")
+
+        for document in documents:
+            if isinstance(document, str) and len(document) > max_document_chars:
+                raise _too_large(
+                    f"Document too large (max {max_document_chars} chars)."
+                )
+
+    query = payload.get("query")
+    if isinstance(query, str) and len(query) > max_query_chars:
+        raise _too_large(f"Query too large (max {max_query_chars} chars).")
+
+
+class CompressedJSONRequest(Request):
+    """
+    Request handling compressed bodies, JSON is parsed with orjson
+
+    the body is read as a stream, with limits checked while reading:
+    Content-Length is checked before reading, the compressed and the
+    decompressed size at every chunk. Compressed data is never kept
+    whole. The decompressed buffer is released after parsing, so only
+    the parsed documents stay in memory (body() is empty after json())
+    """
+
+    # limits, set from config in main
+    max_body_size = 64 * 1024 * 1024
+    max_decompressed_size = 256 * 1024 * 1024
+    payload_limits = None
+
+    async def _read_body(self):
+        content_length = self.headers.get("content-length")
+
+        # early rejection, nothing is read
+        if content_length is not None and int(content_length) > self.max_body_size:
+            raise _too_large()
+
+        decoder = BodyDecoder(
+            self.headers.get("content-encoding", ""), self.max_decompressed_size
+        )
+        buffer = bytearray()
+        received = 0
+
+        async for chunk in self.stream():
+            received += len(chunk)
+
+            if received > self.max_body_size:
+                raise _too_large()
+
+            buffer += decoder.decode(chunk)
+
+        buffer += decoder.flush()
+
+        return buffer
+
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            self._body = await self._read_body()
+
+        return self._body
+
+    async def json(self):
+        if not hasattr(self, "_json"):
+            body = await self.body()
+
+            try:
+                self._json = orjson.loads(body)
+            except orjson.JSONDecodeError as e:
+                # not the default error: it would send back the whole body
+                raise HTTPException(status_code=400, detail="Invalid JSON body.") from e
+
+            # release the buffer (the caller could have a reference to it)
+            if isinstance(body, bytearray):
+                body.clear()
+
+            if self.payload_limits is not None:
+                check_payload_limits(self._json, **self.payload_limits)
+
+        return self._json
+
+
+class CompressedJSONRoute(APIRoute):
+    """
+    route class using CompressedJSONRequest
+    """
+
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+
+        async def custom_route_handler(request: Request):
+            request = CompressedJSONRequest(request.scope, request.receive)
+
+            return await original_route_handler(request)
+
+        return custom_route_handler
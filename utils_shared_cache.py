@@ -0,0 +1,320 @@
+"""
+Cache shared by the worker processes (multi-worker mode)
+
+arrays are saved as .npy files in a directory on tmpfs (/dev/shm) and
+read back memory mapped: all the workers share the same pages,
+nothing is copied in the heap of each process.
+
+    - embeddings: a block (one file) for the chunks of a document,
+      key = model + text and offsets of the chunks (a document embedded
+      by a worker is not embedded again by the others). The index
+      searches the mapped blocks, vectors are not copied
+    - chunks: the offsets (start, end) of the chunks of a text,
+      key = splitter settings + text
+
+files are written atomically (write + rename); when the cache is bigger
+than max_size_mb the least recently used files are removed.
+Settings are in the [shared_cache] section of config.toml
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+ONE_MB = 1024 * 1024
+
+
+def make_key(*parts):
+    """
+    hash of the parts (str)
+    """
+    sha = hashlib.sha1()
+
+    for part in parts:
+        sha.update(part.encode("utf-8"))
+        sha.update(b"\0")
+
+    return sha.hexdigest()
+
+
+class SharedArrayCache:
+    """
+    numpy arrays in memory mapped files, shared between processes
+    """
+
+    def __init__(self, directory, max_size_mb):
+        self.max_bytes = max_size_mb * ONE_MB
+        self.directory = self._prepare_directory(directory)
+
+        # bytes written since the last check of the size
+        self._written = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _prepare_directory(directory):
+        """
+        use the system temp dir if directory can't be used
+        (ex: no /dev/shm on macOS)
+        """
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            directory = os.path.join(tempfile.gettempdir(), "hol_api_cache")
+            logger.info("Shared cache: using %s", directory)
+            os.makedirs(directory, exist_ok=True)
+
+        return directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        """
+        return the array (read only, memory mapped) or None
+        """
+        path = self._path(key)
+
+        try:
+            array = np.load(path, mmap_mode="r")
+            # for LRU eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # not there, or removed by another worker
+            return None
+
+        return array
+
+    def put(self, key, array):
+        """
+        save the array (atomic for the readers)
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            with open(tmp_path, "wb") as file:
+                np.save(file, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Shared cache: error writing %s: %s", key, e)
+            return
+
+        with self._lock:
+            self._written += array.nbytes
+            must_check = self._written > self.max_bytes // 10
+
+            if must_check:
+                self._written = 0
+
+        if must_check:
+            self._evict()
+
+    def _evict(self):
+        """
+        remove the least recently used files, if over max size
+        """
+        entries = []
+        total = 0
+
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".npy"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        # remove until we're at 90% of the max size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """
+    return the shared cache, None if disabled
+    """
+    config = app_config["shared_cache"]
+
+    if not config["enabled"]:
+        return None
+
+    with _caches_lock:
+        if "shared" not in _caches:
+            _caches["shared"] = SharedArrayCache(
+                config["directory"], config["max_size_mb"]
+            )
+
+    return _caches["shared"]
+
+
+def block_key(docs):
+    """
+    key of the vectors of a block of chunks (LangChain Documents):
+    depends on the model, the text and the offsets of the chunks
+    """
+    model_id = app_config["embeddings"]["model_id"]
+
+    return make_key(
+        model_id,
+        *(f"{doc.metadata['start_index']}:{doc.metadata['end_index']}" for doc in docs),
+        *(doc.page_content for doc in docs),
+    )
+
+
+def get_block(key):
+    """
+    return (vectors, offsets) of a block, memory mapped, or None
+    """
+    cache = get_shared_cache()
+
+    if cache is None:
+        return None
+
+    vectors = cache.get(key)
+    offsets = cache.get(key + "-offsets")
+
+    if vectors is None or offsets is None:
+        return None
+
+    return vectors, offsets
+
+
+def embed_blocks(embed_model, blocks):
+    """
+    embed blocks of chunks (normally: the chunks of a document),
+    using the vectors in the shared cache when available
+    blocks: list of lists of LangChain Documents
+    return a list of (key, vectors (n, dim) float32), key is None
+    if the cache is disabled
+
+    a block is saved as one file, read back memory mapped: the index
+    searches the mapped vectors, that are shared by all the workers
+    """
+    cache = get_shared_cache()
+
+    if cache is None:
+        keys = [None] * len(blocks)
+        found = [None] * len(blocks)
+    else:
+        keys = [block_key(docs) for docs in blocks]
+        found = [cache.get(key) for key in keys]
+
+    missing = [i for i, vectors in enumerate(found) if vectors is None]
+
+    if missing:
+        # all the missing blocks in one call (the model batches the texts)
+        new_vectors = np.asarray(
+            embed_model.embed_documents(
+                [doc.page_content for i in missing for doc in blocks[i]]
+            ),
+            dtype=np.float32,
+        )
+
+        start = 0
+        for i in missing:
+            vectors = new_vectors[start : start + len(blocks[i])]
+            start += len(blocks[i])
+
+            if cache is not None:
+                offsets = [
+                    (doc.metadata["start_index"], doc.metadata["end_index"])
+                    for doc in blocks[i]
+                ]
+                cache.put(
+                    keys[i] + "-offsets",
+                    np.asarray(offsets, dtype=np.int64).reshape(-1, 2),
+                )
+                cache.put(keys[i], vectors)
+
+                # the mapped copy, if it's still there
+                mapped = cache.get(keys[i])
+                if mapped is not None:
+                    vectors = mapped
+
+            found[i] = vectors
+
+    if cache is not None and app_config["general"]["verbose"]:
+        logger.info(
+            "Shared cache: %s blocks found, %s computed",
+            len(blocks) - len(missing),
+            len(missing),
+        )
+
+    return list(zip(keys, found))
+
+
+def group_by_document(docs):
+    """
+    split the chunks (in order) in blocks, one per document
+    """
+    blocks = []
+
+    for doc in docs:
+        if blocks and blocks[-1][0].metadata["doc_index"] == doc.metadata["doc_index"]:
+            blocks[-1].append(doc)
+        else:
+            blocks.append([doc])
+
+    return blocks
+
+
+def chunks_key(text):
+    """
+    key for the chunks of a text: depends also on the splitter settings
+    """
+    splitting = app_config["splitting"]
+
+    return make_key(
+        "chunks",
+        str(splitting["max_chunk_size"]),
+        str(splitting["chunk_overlap"]),
+        text,
+    )
+
+
+def get_chunk_offsets(text):
+    """
+    return the offsets (n, 2) of the chunks of text, or None
+    """
+    cache = get_shared_cache()
+
+    if cache is None:
+        return None
+
+    return cache.get(chunks_key(text))
+
+
+def put_chunk_offsets(text, offsets):
+    """
+    save the offsets (n, 2) of the chunks of text
+    """
+    cache = get_shared_cache()
+
+    if cache is not None:
+        cache.put(chunks_key(text), np.asarray(offsets, dtype=np.int64).reshape(-1, 2))
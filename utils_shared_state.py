@@ -0,0 +1,379 @@
+"""
+State shared by the worker processes (multi-worker mode)
+
+with gunicorn (start_api_workers.sh) the requests of a conversation can
+go to any worker, so what must be the same in all the workers is not
+kept in the memory of a process:
+    - the history of the conversations
+    - the settings changed with change_config (model pinned, verbose...)
+    - the status of the prepare jobs
+    - the token buckets of the rate limiter
+    - the layout of the conversation indexes (see utils_index_cache)
+
+records are small JSON files in a directory on tmpfs (a subdirectory
+for each namespace), read and updated under a file lock (flock), so the
+updates of different processes are serialized. Locks on a name (ex: a conversation) serialize longer work.
+In single process mode (python main.py) records are kept in memory.
+
+gunicorn.conf.py sets SHARED_STATE_ENV and empties the directory at
+startup. Settings are in the [shared_state] section of config.toml
+"""
+
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import orjson
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+# set (by gunicorn.conf.py) when the API runs with more worker processes
+SHARED_STATE_ENV = "HOL_API_SHARED_STATE"
+
+# changes made with change_config, applied by every worker
+CONFIG_KEY = "config:overrides"
+
+
+class FileStateStore:
+    """
+    records in files, shared by the processes
+    key: "namespace:name"
+    """
+
+    shared = True
+
+    def __init__(self, directory):
+        self.directory = self._prepare_directory(directory)
+        # namespaces with the subdirectory already created
+        self._namespaces = set()
+
+    @staticmethod
+    def _prepare_directory(directory):
+        """
+        use the system temp dir if directory can't be used
+        """
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            directory = os.path.join(tempfile.gettempdir(), "hol_api_state")
+            logger.info("Shared state: using %s", directory)
+            os.makedirs(directory, exist_ok=True)
+
+        return directory
+
+    def _namespace_dir(self, namespace):
+        """
+        the subdirectory of a namespace, created at first use
+        """
+        path = os.path.join(self.directory, namespace)
+
+        if namespace not in self._namespaces:
+            os.makedirs(path, exist_ok=True)
+            self._namespaces.add(namespace)
+
+        return path
+
+    def _path(self, key, suffix=".json"):
+        namespace, _, name = key.partition(":")
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+        return os.path.join(self._namespace_dir(namespace), digest + suffix)
+
+    @contextmanager
+    def _locked(self, path, exclusive=True, create=True):
+        """
+        open path and lock it, yield the fd (None if not there)
+
+        a file removed (or replaced) while we were waiting for the lock
+        is not the record anymore: in that case we open it again
+        """
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+
+        while True:
+            try:
+                fd = os.open(path, flags, 0o644)
+            except FileNotFoundError:
+                yield None
+                return
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+                try:
+                    same_file = os.stat(path).st_ino == os.fstat(fd).st_ino
+                except FileNotFoundError:
+                    same_file = False
+
+                if same_file:
+                    yield fd
+                    return
+            finally:
+                # releases the lock
+                os.close(fd)
+
+            if not create:
+                yield None
+                return
+
+    @staticmethod
+    def _read(fd):
+        data = b""
+        while True:
+            chunk = os.read(fd, 1 << 20)
+            if not chunk:
+                break
+            data += chunk
+
+        if not data:
+            return None
+
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # partially written by a process that died
+            return None
+
+    def get(self, key):
+        """
+        return the record, None if not there
+        """
+        with self._locked(self._path(key), exclusive=False, create=False) as fd:
+            return None if fd is None else self._read(fd)
+
+    def update(self, key, func):
+        """
+        record = func(record), atomically for all the processes
+        func gets None if the record is not there, returns None to delete it
+        return the new record
+        """
+        path = self._path(key)
+
+        with self._locked(path) as fd:
+            record = func(self._read(fd))
+
+            if record is None:
+                os.remove(path)
+            else:
+                data = orjson.dumps(record)
+
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+
+        return record
+
+    def put(self, key, record):
+        """
+        save the record
+        """
+        return self.update(key, lambda _: record)
+
+    def delete(self, key):
+        """
+        remove the record, return True if it was there
+        """
+        path = self._path(key)
+
+        with self._locked(path, create=False) as fd:
+            if fd is None:
+                return False
+
+            existed = self._read(fd) is not None
+            os.remove(path)
+
+        return existed
+
+    def version(self, key):
+        """
+        changes when the record is updated (None if not there)
+        """
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @contextmanager
+    def lock(self, key):
+        """
+        exclusive lock on key, for all the processes
+        (ex: the update of the index of a conversation)
+        the lock files are not removed: a process could be waiting
+        """
+        with self._locked(self._path(key, ".lock")):
+            yield
+
+    def remove_idle(self, namespace, max_idle):
+        """
+        remove the records of namespace not updated for max_idle sec.
+        (only the subdirectory of the namespace is scanned)
+        """
+        limit = time.time() - max_idle
+
+        for entry in os.scandir(self._namespace_dir(namespace)):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                if entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """
+        remove all the records (at startup)
+        """
+        for namespace in os.scandir(self.directory):
+            if not namespace.is_dir():
+                continue
+
+            for entry in os.scandir(namespace.path):
+                if entry.name.endswith((".json", ".lock")):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+
+class MemoryStateStore:
+    """
+    records in memory, same interface of FileStateStore (single process)
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._records = {}
+        # key -> (version, time of the last update)
+        self._versions = {}
+        self._locks = {}
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            return self._records.get(key)
+
+    def update(self, key, func):
+        with self._lock:
+            record = func(self._records.get(key))
+
+            if record is None:
+                self._records.pop(key, None)
+                self._versions.pop(key, None)
+            else:
+                self._records[key] = record
+                self._versions[key] = (
+                    self._versions.get(key, (0,))[0] + 1,
+                    time.time(),
+                )
+
+        return record
+
+    def put(self, key, record):
+        return self.update(key, lambda _: record)
+
+    def delete(self, key):
+        with self._lock:
+            self._versions.pop(key, None)
+
+            return self._records.pop(key, None) is not None
+
+    def version(self, key):
+        with self._lock:
+            version = self._versions.get(key)
+
+        return None if version is None else version[0]
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            yield
+
+    def remove_idle(self, namespace, max_idle):
+        limit = time.time() - max_idle
+
+        with self._lock:
+            for key, (_, updated) in list(self._versions.items()):
+                if key.startswith(namespace + ":") and updated < limit:
+                    self._records.pop(key, None)
+                    del self._versions[key]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._versions.clear()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_shared_state():
+    """
+    return the store: in files with more workers, in memory otherwise
+    """
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            if os.environ.get(SHARED_STATE_ENV):
+                _store = FileStateStore(app_config["shared_state"]["directory"])
+            else:
+                _store = MemoryStateStore()
+
+    return _store
+
+
+#
+# settings changed with change_config
+#
+_config_version = None
+
+
+def _apply_overrides(overrides):
+    """
+    overrides: "section.key" -> value
+    """
+    for name, value in overrides.items():
+        section, key = name.split(".", 1)
+        app_config[section][key] = value
+
+
+def set_config_overrides(overrides):
+    """
+    change settings in all the workers
+    overrides: "section.key" -> value
+    """
+    state = get_shared_state()
+
+    state.update(CONFIG_KEY, lambda current: {**(current or {}), **overrides})
+    _apply_overrides(overrides)
+
+
+def sync_config_overrides():
+    """
+    apply the settings changed (by any worker) since the last call
+    it costs a stat() if nothing has changed
+    """
+    global _config_version
+
+    state = get_shared_state()
+    version = state.version(CONFIG_KEY)
+
+    if version is None or version == _config_version:
+        return
+
+    _config_version = version
+    _apply_overrides(state.get(CONFIG_KEY) or {})
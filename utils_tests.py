@@ -6,10 +6,10 @@ Python: 3.11
 import json
 import requests
 
-from utils import read_configuration
+from utils import get_app_config
 
 # configs
-app_config = read_configuration("config.toml")
+app_config = get_app_config()
 
 API_PORT = app_config["fastapi"]["api_port"]
 
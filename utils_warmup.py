@@ -0,0 +1,183 @@
+"""
+Warm-up of the API, done at startup in a background thread
+
+    - import the heavy modules (LangChain, FAISS, OCI)
+    - create the clients for chat and embeddings (and open the connection)
+    - start the pool of processes for CPU bound work
+    - build and query a tiny index
+
+the API starts serving immediately, the readiness endpoint
+reports when the warm-up is done.
+Settings are in the [warmup] section of config.toml
+"""
+
+import importlib
+import threading
+import time
+
+from utils import get_app_config, get_console_logger
+
+app_config = get_app_config()
+
+logger = get_console_logger()
+
+WARMUP_TEXT = "warm-up"
+
+# heavy modules not imported at startup
+DEFERRED_MODULES = [
+    "langchain_core.messages",
+    "langchain_text_splitters",
+    "faiss",
+    "utils_index",
+    "utils_index_cache",
+    "utils_rerank",
+    "langchain_community.chat_models.oci_generative_ai",
+    "oci_cohere_embeddings_utils",
+]
+
+# warm-up status
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
+
+class WarmupState:
+    """
+    keep track of the warm-up progress
+    """
+
+    def __init__(self):
+        self.status = STATUS_PENDING
+        # elapsed time (sec.) for every step completed
+        self.steps = {}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def run_step(self, name, func):
+        """
+        run a step, errors are logged and recorded, not raised
+        """
+        time_start = time.time()
+
+        try:
+            func()
+        except Exception as e:
+            logger.error("Error in warm-up step %s: %s", name, e)
+
+            with self._lock:
+                self.errors.append(f"{name}: {e}")
+            return
+
+        with self._lock:
+            self.steps[name] = round(time.time() - time_start, 2)
+
+    def is_ready(self):
+        """
+        the API is ready when the warm-up is completed
+        (and, if required, without errors)
+        """
+        if app_config["warmup"]["fail_readiness_on_error"]:
+            return self.status == STATUS_READY
+
+        return self.status in (STATUS_READY, STATUS_FAILED)
+
+    def to_dict(self):
+        """
+        for the readiness endpoint
+        """
+        with self._lock:
+            return {
+                "ready": self.is_ready(),
+                "status": self.status,
+                "steps": dict(self.steps),
+                "errors": list(self.errors),
+            }
+
+
+warmup_state = WarmupState()
+
+
+def _import_modules():
+    """
+    import the modules we have deferred at startup
+    """
+    for module_name in DEFERRED_MODULES:
+        importlib.import_module(module_name)
+
+
+def _create_clients():
+    """
+    create the clients (they're cached in utils_models)
+    """
+    from utils_models import get_embedding_model
+    from utils_routing import warm_clients
+
+    # the clients of all the models the router can choose
+    warm_clients()
+    get_embedding_model()
+
+
+def _build_index():
+    """
+    build and query a tiny index
+    the embedding call opens the connection to the service (TLS)
+    """
+    from utils_chuncking import split_in_chunks
+    from utils_index import build_chunk_index
+    from utils_models import get_embedding_model
+
+    docs = split_in_chunks([WARMUP_TEXT])
+
+    index = build_chunk_index(docs, get_embedding_model())
+    index.search(index.get_vectors([0])[0], k=1)
+
+
+def _start_process_pool():
+    """
+    start the processes for CPU bound work
+    """
+    from utils_executor import warm_process_pool
+
+    warm_process_pool()
+
+
+def run_warmup():
+    """
+    do all the warm-up steps
+    """
+    config = app_config["warmup"]
+
+    warmup_state.status = STATUS_RUNNING
+    logger.info("Warm-up started...")
+    time_start = time.time()
+
+    warmup_state.run_step("imports", _import_modules)
+
+    warmup_state.run_step("process_pool", _start_process_pool)
+
+    if config["prewarm_clients"]:
+        warmup_state.run_step("clients", _create_clients)
+
+    if config["prewarm_index"]:
+        warmup_state.run_step("index", _build_index)
+
+    warmup_state.status = STATUS_FAILED if warmup_state.errors else STATUS_READY
+
+    logger.info(
+        "Warm-up completed in %s sec., status: %s",
+        round(time.time() - time_start, 1),
+        warmup_state.status,
+    )
+
+
+def start_warmup():
+    """
+    start the warm-up in a background thread
+    """
+    if not app_config["warmup"]["enabled"]:
+        warmup_state.status = STATUS_READY
+        return
+
+    thread = threading.Thread(target=run_warmup, name="warmup", daemon=True)
+    thread.start()